@@ -349,7 +349,7 @@ def show_deck(deck):
     cards = []
     # Show cards at 300x450 for much greater visibility
     for card_id in deck:
-        img_path = f"/cards_framed/{card_id}.png"
+        img_path = f"/cards_framed/{utils.card_image(card_id, 'thumb')}"
         cards.append(
             dmc.Stack([
                 html.Div([
@@ -413,7 +413,7 @@ def update_cards(faction, mana, advancing, shield, condition, effect, deck):
         filtered = filtered.filter(pl.col('effect').is_in(effect))
     cards = []
     for row in filtered.iter_rows(named=True):
-        img_path = f"/cards_framed/{row['card_id']}.png"
+        img_path = f"/cards_framed/{utils.card_image(row['card_id'], 'web')}"
         card = dbc.Card([
             html.Div([
                 dbc.CardImg(src=img_path, top=True, style={'objectFit': 'contain', 'width': '100%', 'height': 'auto', 'maxHeight': '350px', 'background': "#0e0e0e"}),
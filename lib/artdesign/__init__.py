@@ -1,76 +1,622 @@
 import websocket  # websocket-client
 import uuid
 import json
-import urllib.request
 import urllib.parse
+import urllib.error
+import http.client
+import queue
+import select
+import weakref
 import os
-from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageChops
+import types
+import asyncio
+import threading
+import collections
+import time
+import hashlib
+import shutil
+import struct
+import csv
+import heapq
+import itertools
+import concurrent.futures
+import functools
+from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageChops, ImageColor
 import io
 import numpy as np
+import polars as pl
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.utils import ImageReader
 import io
 
 
+class ArtCache:
+    """ on-disk cache of generated images, keyed by a hash of the final workflow (prompts, parameters and seed of node 3) """
+    def __init__(self, cache_dir, max_mb=2048):
+        """
+            cache_dir: folder of the cache, one sub-folder per workflow hash holding its png files
+            max_mb: size cap of the cache, the least recently used entries are evicted above it
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # {key: size in bytes}, least recently used first
+        self._size_bytes = 0                        # sum of self._entries, kept up to date by put and the evictions
+        os.makedirs(cache_dir, exist_ok=True)
+        found = []
+        for key in os.listdir(cache_dir):
+            entry_dir = os.path.join(cache_dir, key)
+            if not os.path.isdir(entry_dir) or key.startswith('.'):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+            found.append((os.path.getmtime(entry_dir), key, size))
+        for _, key, size in sorted(found):
+            self._entries[key] = size
+            self._size_bytes += size
+
+    @staticmethod
+    def key(workflow):
+        return hashlib.sha256(json.dumps(workflow, sort_keys=True).encode('utf-8')).hexdigest()
+
+    @property
+    def size_bytes(self):
+        return self._size_bytes
+
+    def get(self, key):
+        """ returns {node_id: [image bytes, ...]} or None if the workflow was never generated """
+        with self._lock:
+            if key not in self._entries:
+                self.stats["misses"] += 1
+                return None
+            entry_dir = os.path.join(self.cache_dir, key)
+            output_images = {}
+            for filename in sorted(os.listdir(entry_dir), key=lambda f: int(f.rsplit('_', 1)[1].split('.')[0])):
+                node_id = filename.rsplit('_', 1)[0]
+                with open(os.path.join(entry_dir, filename), 'rb') as file:
+                    output_images.setdefault(node_id, []).append(file.read())
+            self._entries.move_to_end(key)
+            os.utime(entry_dir)
+            self.stats["hits"] += 1
+            return output_images
+
+    def put(self, key, output_images):
+        """ stores {node_id: [image bytes, ...]} and evicts the least recently used entries above the size cap """
+        with self._lock:
+            tmp_dir = os.path.join(self.cache_dir, f".{key}.{uuid.uuid4().hex}")
+            os.makedirs(tmp_dir)
+            size = 0
+            for node_id in output_images:
+                for i, image_data in enumerate(output_images[node_id]):
+                    with open(os.path.join(tmp_dir, f"{node_id}_{i}.png"), 'wb') as file:
+                        file.write(image_data)
+                    size += len(image_data)
+            entry_dir = os.path.join(self.cache_dir, key)
+            if key in self._entries:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                self._size_bytes -= self._entries[key]
+            os.replace(tmp_dir, entry_dir)
+            self._entries[key] = size
+            self._size_bytes += size
+            self._entries.move_to_end(key)
+            self.stats["writes"] += 1
+            while self._size_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._size_bytes -= old_size
+                shutil.rmtree(os.path.join(self.cache_dir, old_key), ignore_errors=True)
+                self.stats["evictions"] += 1
+
+    def report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats, entries=len(self._entries), size_mb=round(self.size_bytes / 1024 / 1024, 2),
+                    hit_rate=round(self.stats["hits"] / lookups, 3) if lookups else 0.0)
+
+
+class JobTimer:
+    """ per prompt and per node timings built from the ComfyUI websocket messages, exported as json or csv """
+    def __init__(self):
+        self.jobs = {}   # {prompt_id: timing record}
+        self._lock = threading.Lock()
+
+    def queued(self, prompt_id, workflow, label=None):
+        with self._lock:
+            self.jobs[prompt_id] = {
+                "prompt_id": prompt_id,
+                "label": label,
+                "queued": time.time(),
+                "start": None,
+                "end": None,
+                "download": None,
+                "cancelled": None,  # seconds it had been running when job_timeout cancelled it
+                "class_types": {node_id: node["class_type"] for node_id, node in workflow.items()},
+                "nodes": {},        # {node_id: {"start", "seconds", "steps", "cached"}}
+                "current": None,    # node being executed
+            }
+
+    def on_message(self, message):
+        data = message.get('data') or {}
+        now = time.time()
+        with self._lock:
+            job = self.jobs.get(data.get('prompt_id'))
+            if job is None:
+                return
+            if message['type'] == 'execution_start':
+                job["start"] = now
+            elif message['type'] == 'execution_cached':
+                for node_id in data.get('nodes', []):
+                    job["nodes"][node_id] = {"start": now, "seconds": 0.0, "steps": 0, "cached": True}
+            elif message['type'] == 'executing':
+                self._close_node(job, now)
+                if data['node'] is None:
+                    job["end"] = now
+                else:
+                    job["current"] = data['node']
+                    job["nodes"].setdefault(data['node'], {"start": now, "seconds": 0.0, "steps": 0, "cached": False})["start"] = now
+            elif message['type'] == 'progress':
+                node = job["nodes"].get(data.get('node') or job["current"])
+                if node is not None:
+                    node["steps"] = data.get('value', node["steps"] + 1)
+            elif message['type'] in ('execution_success', 'execution_error', 'execution_interrupted'):
+                self._close_node(job, now)
+                job["end"] = job["end"] or now
+
+    @staticmethod
+    def _close_node(job, now):
+        if job["current"] is not None:
+            node = job["nodes"][job["current"]]
+            node["seconds"] += now - node["start"]
+            job["current"] = None
+
+    def downloaded(self, prompt_id, seconds):
+        with self._lock:
+            if prompt_id in self.jobs:
+                self.jobs[prompt_id]["download"] = seconds
+
+    def cancelled(self, prompt_id, seconds):
+        """ the prompt ran for seconds and was cancelled by the client (job_timeout) """
+        with self._lock:
+            if prompt_id in self.jobs:
+                self.jobs[prompt_id]["cancelled"] = seconds
+
+    def records(self):
+        """ one dict per prompt: queue wait, execution and download seconds plus the per node details """
+        records = []
+        with self._lock:
+            for job in self.jobs.values():
+                start, end = job["start"], job["end"]
+                records.append({
+                    "prompt_id": job["prompt_id"],
+                    "label": job["label"],
+                    "queue_wait": round(start - job["queued"], 4) if start else None,
+                    "execution": round(end - start, 4) if start and end else None,
+                    "download": round(job["download"], 4) if job["download"] is not None else None,
+                    "total": round(end - job["queued"] + (job["download"] or 0), 4) if end else None,
+                    "cancelled": round(job["cancelled"], 4) if job["cancelled"] is not None else None,
+                    "nodes": {node_id: {"class_type": job["class_types"].get(node_id), "seconds": round(node["seconds"], 4),
+                                        "steps": node["steps"], "cached": node["cached"]}
+                              for node_id, node in job["nodes"].items()},
+                })
+        return records
+
+    def summary(self):
+        """ mean seconds per phase and per node class_type over the finished prompts, and the number of cancelled ones """
+        all_records = self.records()
+        records = [record for record in all_records if record["execution"] is not None and record["cancelled"] is None]
+        summary = {"prompts": len(records), "cancelled": sum(1 for record in all_records if record["cancelled"] is not None)}
+        for phase in ("queue_wait", "execution", "download", "total"):
+            values = [record[phase] for record in records if record[phase] is not None]
+            summary[phase] = round(sum(values) / len(values), 4) if values else None
+        per_class = collections.defaultdict(list)
+        for record in records:
+            for node in record["nodes"].values():
+                if not node["cached"]:
+                    per_class[node["class_type"]].append(node["seconds"])
+        summary["nodes"] = {class_type: round(sum(values) / len(values), 4) for class_type, values in per_class.items()}
+        return summary
+
+    def to_json(self, path):
+        with open(path, 'w') as file:
+            json.dump({"summary": self.summary(), "prompts": self.records()}, file, indent=2)
+
+    def to_csv(self, path):
+        """ one row per (prompt, node), the queue wait and the download being written as the nodes 'queue' and 'download' """
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["prompt_id", "label", "node", "class_type", "seconds", "steps", "cached"])
+            for record in self.records():
+                writer.writerow([record["prompt_id"], record["label"], "queue", "", record["queue_wait"], "", ""])
+                for node_id, node in record["nodes"].items():
+                    writer.writerow([record["prompt_id"], record["label"], node_id, node["class_type"], node["seconds"], node["steps"], node["cached"]])
+                writer.writerow([record["prompt_id"], record["label"], "download", "", record["download"], "", ""])
+
+
+class HttpConnectionPool:
+    """
+        persistent HTTP/1.1 connections to one ComfyUI server, shared by the threads of a client: a /prompt, a /history
+        and six /view calls go through the same TCP connection instead of opening eight
+    """
+    RETRYABLE = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError, http.client.CannotSendRequest)
+    IDEMPOTENT = ("GET", "HEAD")
+
+    def __init__(self, server_address, size=4, timeout=60):
+        """
+            size: idle connections kept open, a busier moment opens extra ones that are closed after their request
+            timeout: seconds before a request fails
+        """
+        self.server_address = server_address
+        self.size = size
+        self.timeout = timeout
+        self.stats = {"requests": 0, "connections": 0, "reused": 0, "retries": 0}
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _acquire(self):
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                self._count("connections")
+                return http.client.HTTPConnection(self.server_address, timeout=self.timeout), False
+            if connection.sock is not None and select.select([connection.sock], [], [], 0)[0]:
+                connection.close()   # readable while idle: the server closed it (keep-alive timeout), don't send on it
+                continue
+            return connection, True
+
+    def _release(self, connection):
+        if self._idle.qsize() < self.size:
+            self._idle.put(connection)
+        else:
+            connection.close()
+
+    def request(self, method, path, body=None, headers=None):
+        """
+            returns the response body, raises urllib.error.HTTPError on an error status like urlopen
+            A reused connection the server closed is retried on a fresh one, except for a POST that was fully sent: the
+            server may have run it (a /prompt queued twice), so that error is raised.
+        """
+        self._count("requests")
+        while True:
+            connection, reused = self._acquire()
+            sent = False
+            try:
+                connection.request(method, path, body=body, headers=headers or {})
+                sent = True
+                response = connection.getresponse()
+                data = response.read()
+            except self.RETRYABLE:
+                connection.close()
+                if not reused or (sent and method not in self.IDEMPOTENT):
+                    raise
+                self._count("retries")   # the server closed an idle connection, try again on a fresh one
+                continue
+            except http.client.HTTPException as e:
+                connection.close()
+                raise ConnectionError(f"{method} {path}: {e!r}") from e
+            except BaseException:
+                connection.close()
+                raise
+            if reused:
+                self._count("reused")
+            if response.will_close:
+                connection.close()
+            else:
+                self._release(connection)
+            if response.status >= 400:
+                raise urllib.error.HTTPError(f"http://{self.server_address}{path}", response.status, response.reason, response.headers, io.BytesIO(data))
+            return data
+
+    def report(self):
+        """ stats + share of the requests that reused an open connection """
+        with self._lock:
+            stats = dict(self.stats)
+        stats["size"] = self.size
+        stats["idle"] = self._idle.qsize()
+        stats["reuse_rate"] = round(stats["reused"] / stats["requests"], 3) if stats["requests"] else None
+        return stats
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
 class ArtDesignClient:
-    """ class using ComfyUI for AI art generation """
-    def __init__(self, server_address="127.0.0.1:8000"):
+    """
+        class using ComfyUI for AI art generation
+        The workflow is an immutable template, every prompt gets its own patched copy (see build_workflow) so one client
+        can be shared by several threads (e.g. a ThreadPoolExecutor), each thread having its own websocket.
+    """
+    SAVE_NODE = "77"
+
+    def __init__(self, server_address="127.0.0.1:8000", session=False, cache=None, ws_output=False, timer=None,
+                 job_timeout=None, max_requeue=1, http_timeout=60, http_pool_size=4):
+        """
+            session: if True, one websocket is kept open for the client's lifetime instead of one per run_prompts call.
+                Call close() (or use the client as a context manager) when done.
+            cache: optional ArtCache, run_prompts then only sends to ComfyUI the workflows it has never generated
+            ws_output: if True, the SaveImage node is swapped for SaveImageWebsocket and the images are read from the
+                websocket binary frames (no /history and /view requests, nothing written in ComfyUI/output)
+            timer: optional JobTimer recording the queue wait, per node and download time of every prompt
+            job_timeout: seconds a prompt may run on ComfyUI, after that it is cancelled (/interrupt and /queue delete)
+                and queued again up to max_requeue times, then given up (no image) while the rest of the batch goes on
+            http_timeout: seconds before a REST call to ComfyUI fails
+            http_pool_size: keep-alive connections kept open for the REST calls, see self.http.report()
+        """
         self.server_address = server_address
         self.client_id = str(uuid.uuid4())
-        self.workflow = self._load_workflow()
+        self.ws_output = ws_output
+        self.session = session
+        self.cache = cache
+        self.timer = timer
+        self.job_timeout = job_timeout
+        self.max_requeue = max_requeue
+        self.http_timeout = http_timeout
+        self.http = HttpConnectionPool(server_address, size=http_pool_size, timeout=http_timeout)
+        self._lock = threading.Lock()
+        self._local = threading.local()   # per thread: session websocket and its client_id, node being executed
+        self._session_sockets = weakref.WeakValueDictionary()   # {thread ident: its session websocket}, gone with the thread
+        self._set_template(self._load_workflow())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
 
     def _load_workflow(self):
         path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "image_qwen_python.json")
         with open(path, 'r') as file:
-            return json.load(file)
+            workflow = json.load(file)
+        if self.ws_output:
+            workflow[self.SAVE_NODE] = {"inputs": {"images": workflow[self.SAVE_NODE]["inputs"]["images"]}, "class_type": "SaveImageWebsocket"}
+        return workflow
+
+    def _set_template(self, workflow):
+        """ replaces the template as a whole (never modified in place, so a thread building a workflow never sees half of an update) """
+        self._template = workflow
+        self._frozen = self._freeze(workflow)
+
+    @classmethod
+    def _freeze(cls, obj):
+        if isinstance(obj, dict):
+            return types.MappingProxyType({key: cls._freeze(value) for key, value in obj.items()})
+        if isinstance(obj, list):
+            return tuple(cls._freeze(value) for value in obj)
+        return obj
+
+    @property
+    def workflow(self):
+        """ read-only view of the workflow template, use build_workflow or update_workflow_with_text to change it """
+        return self._frozen
+
+    def connect(self, client_id=None):
+        """ ComfyUI sends the messages of a prompt to the websocket of the client_id it was queued with """
+        ws = websocket.WebSocket()
+        ws.connect(f"ws://{self.server_address}/ws?clientId={client_id or self.client_id}", timeout=self.http_timeout)
+        ws.settimeout(None)   # a job can take minutes, the deadlines are handled by iter_finished
+        return ws
+
+    def get_ws(self):
+        """
+            returns (websocket, client_id) to queue and follow prompts with: the session websocket of the calling thread
+            (reconnecting it if it dropped), or a new one if not in session mode
+        """
+        if not self.session:
+            client_id = str(uuid.uuid4())
+            return self.connect(client_id), client_id
+        ws = getattr(self._local, 'ws', None)
+        if ws is None or not ws.connected:
+            if not hasattr(self._local, 'client_id'):
+                self._local.client_id = str(uuid.uuid4())
+            if ws is not None:
+                ws.close()   # dropped, replaced below
+            ws = self.connect(self._local.client_id)
+            self._local.ws = ws
+            with self._lock:
+                self._session_sockets[threading.get_ident()] = ws
+        return ws, self._local.client_id
+
+    def release_ws(self, ws):
+        if not self.session:
+            ws.close()
+
+    def close(self):
+        """ closes the session websockets of every thread and the idle HTTP connections """
+        with self._lock:
+            sockets = list(self._session_sockets.values())
+            self._session_sockets.clear()
+        for ws in sockets:
+            ws.close()
+        self.http.close()
 
-    def queue_prompt(self, prompt, prompt_id):
-        p = {"prompt": prompt, "client_id": self.client_id, "prompt_id": prompt_id}
+    def queue_prompt(self, prompt, prompt_id, label=None, client_id=None, front=False):
+        """
+            label: name of the job in the timer records (e.g. the card_id)
+            client_id: id of the websocket following the prompt, see get_ws
+            front: if True, ComfyUI puts the prompt at the front of its queue (it still waits for the running one)
+        """
+        p = {"prompt": prompt, "client_id": client_id or self.client_id, "prompt_id": prompt_id}
+        if front:
+            p["front"] = True
         data = json.dumps(p).encode('utf-8')
-        req = urllib.request.Request(f"http://{self.server_address}/prompt", data=data)
-        urllib.request.urlopen(req).read()
+        if self.timer is not None:
+            self.timer.queued(prompt_id, prompt, label=label)
+        self.http.request("POST", "/prompt", body=data, headers={"Content-Type": "application/json"})
     
     def get_image(self, filename, subfolder, folder_type):
         data = {"filename": filename, "subfolder": subfolder, "type": folder_type}
         url_values = urllib.parse.urlencode(data)
-        with urllib.request.urlopen(f"http://{self.server_address}/view?{url_values}") as response:
-            return response.read()
+        return self.http.request("GET", f"/view?{url_values}")
 
     def get_history(self, prompt_id):
-        with urllib.request.urlopen(f"http://{self.server_address}/history/{prompt_id}") as response:
-            return json.loads(response.read())
+        return json.loads(self.http.request("GET", f"/history/{prompt_id}"))
 
-    def get_images(self, ws, prompt):
-        prompt_id = str(uuid.uuid4())
-        self.queue_prompt(prompt, prompt_id)
-        output_images = {}
-        while True:
-            out = ws.recv()
-            if isinstance(out, str):
-                message = json.loads(out)
-                if message['type'] == 'executing':
-                    data = message['data']
-                    if data['node'] is None and data['prompt_id'] == prompt_id:
-                        break
-            else:
-                continue
+    def get_queue(self):
+        return json.loads(self.http.request("GET", "/queue"))
+
+    def get_running_prompt_ids(self):
+        return [item[1] for item in self.get_queue().get('queue_running', [])]
+
+    def cancel_prompt(self, prompt_id):
+        """ removes a prompt from the ComfyUI queue and interrupts it if it is running """
+        for path, body in (("queue", {"delete": [prompt_id]}), ("interrupt", {"prompt_id": prompt_id})):
+            data = json.dumps(body).encode('utf-8')
+            self.http.request("POST", f"/{path}", body=data, headers={"Content-Type": "application/json"})
+
+    def get_queue_depth(self):
+        """ number of jobs running or pending on the server, all clients included """
+        queue = self.get_queue()
+        return len(queue.get('queue_running', [])) + len(queue.get('queue_pending', []))
+
+    def route_message(self, out, outputs):
+        """
+            files a websocket message under its prompt_id in outputs ({prompt_id: {node_id: [image info or image bytes, ...]}})
+            returns the prompt_id if the message says that this prompt is done, None otherwise
+        """
+        if not isinstance(out, str):
+            # binary frames: 4 bytes event type, 4 bytes image format, then the image. Only the ones sent while the
+            # SaveImageWebsocket node runs are outputs, the others are latent previews of the sampler
+            executing = getattr(self._local, 'executing', None)
+            if executing is not None and executing[1] == self.SAVE_NODE and executing[0] in outputs:
+                if struct.unpack('>I', out[:4])[0] == 1:
+                    outputs[executing[0]].setdefault(self.SAVE_NODE, []).append(out[8:])
+            return None
+        message = json.loads(out)
+        if self.timer is not None:
+            self.timer.on_message(message)
+        data = message.get('data') or {}
+        prompt_id = data.get('prompt_id')
+        if message['type'] == 'executing':
+            self._local.executing = (prompt_id, data.get('node'))
+        if prompt_id not in outputs:
+            return None
+        if message['type'] == 'executed':
+            images = (data.get('output') or {}).get('images')
+            if images:
+                outputs[prompt_id].setdefault(data['node'], []).extend(images)
+        elif message['type'] == 'executing' and data['node'] is None:
+            return prompt_id
+        elif message['type'] in ('execution_error', 'execution_interrupted'):
+            return prompt_id
+        return None
+
+    def iter_finished(self, ws, prompt_ids, requeue=None):
+        """
+            reads the websocket until every prompt of prompt_ids is done, routing the messages by prompt_id
+            yields (prompt_id, {node_id: [image info, ...]}) as soon as each prompt is done
+            With a job_timeout, a prompt running for longer than that is cancelled. requeue(prompt_id) then returns the
+            prompt_id it was queued again with, or None to give it up: it is yielded as (prompt_id, None). The
+            cancellations are recorded in the timer (see JobTimer.cancelled).
+        """
+        outputs = {prompt_id: {} for prompt_id in prompt_ids}
+        started = {}   # {prompt_id: time ComfyUI started running it}
+        last_message = time.time()
+        if self.job_timeout:
+            ws.settimeout(min(1.0, self.job_timeout))
+        try:
+            while outputs:
+                try:
+                    out = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    out = None
+                now = time.time()
+                if out is not None:
+                    last_message = now
+                    prompt_id = self.route_message(out, outputs)
+                    if prompt_id is not None:
+                        started.pop(prompt_id, None)
+                        yield prompt_id, outputs.pop(prompt_id)
+                        continue
+                    executing = getattr(self._local, 'executing', None)
+                    if executing is not None and executing[0] in outputs:
+                        started.setdefault(executing[0], now)
+                if not self.job_timeout:
+                    continue
+                if not started and now - last_message > self.job_timeout:
+                    # ComfyUI silent for too long, the start of one of our prompts may have been missed
+                    for prompt_id in self.get_running_prompt_ids():
+                        if prompt_id in outputs:
+                            started[prompt_id] = last_message
+                    last_message = now
+                for prompt_id in [prompt_id for prompt_id, start in started.items() if now - start > self.job_timeout]:
+                    if self.timer is not None:
+                        self.timer.cancelled(prompt_id, now - started[prompt_id])
+                    del started[prompt_id]
+                    del outputs[prompt_id]
+                    self.cancel_prompt(prompt_id)
+                    new_prompt_id = requeue(prompt_id) if requeue is not None else None
+                    if new_prompt_id is not None:
+                        outputs[new_prompt_id] = {}
+                    else:
+                        yield prompt_id, None
+        finally:
+            if self.job_timeout:
+                ws.settimeout(None)
 
-        history = self.get_history(prompt_id)[prompt_id]
-        for node_id in history['outputs']:
-            node_output = history['outputs'][node_id]
+    def wait_for_prompts(self, ws, prompt_ids):
+        """ same as iter_finished but returns {prompt_id: {node_id: [image info, ...]}} once all the prompts are done """
+        return dict(self.iter_finished(ws, prompt_ids))
+
+    def download_images(self, prompt_id, node_outputs):
+        """
+            downloads the images listed in node_outputs (images already received on the websocket are kept as they are),
+            falls back on /history if no 'executed' message was received
+        """
+        start = time.time()
+        if not node_outputs:
+            history = self.get_history(prompt_id).get(prompt_id, {})
+            node_outputs = {node_id: node_output.get('images', []) for node_id, node_output in history.get('outputs', {}).items()}
+        output_images = {}
+        for node_id in node_outputs:
             images_output = []
-            if 'images' in node_output:
-                for image in node_output['images']:
-                    # print(f'image: {image['filename']} generated in C:\softs\ComfyUI\output')
-                    image_data = self.get_image(image['filename'], image['subfolder'], image['type'])
-                    images_output.append(image_data)
+            for image in node_outputs[node_id]:
+                if isinstance(image, bytes):
+                    images_output.append(image)
+                    continue
+                image_data = self.get_image(image['filename'], image['subfolder'], image['type'])
+                images_output.append(image_data)
             output_images[node_id] = images_output
-
+        if self.timer is not None:
+            self.timer.downloaded(prompt_id, time.time() - start)
         return output_images
 
+    def get_images(self, ws, prompt):
+        prompt_id = str(uuid.uuid4())
+        self.queue_prompt(prompt, prompt_id)
+        outputs = self.wait_for_prompts(ws, [prompt_id])
+        return self.download_images(prompt_id, outputs[prompt_id])
+
+    def build_workflow(self, prompt_txt, size=(400,400), im_number=1, shift=3.10, steps=30, cfg=5):
+        """
+            returns the workflow set up for one (positive prompt, negative prompt), see run_prompts for the parameters
+            Only the patched nodes (3, 6, 7, 58, 66) are copied, the other ones are shared with the template: read-only.
+        """
+        template = self._template
+        patches = {
+            "3": {"steps": steps, "cfg": cfg},
+            "6": {"text": prompt_txt[0]},
+            "7": {"text": prompt_txt[1]},
+            "58": {"width": size[0], "height": size[1], "batch_size": im_number},
+            "66": {"shift": shift},
+        }
+        workflow = dict(template)
+        for node_id, inputs in patches.items():
+            workflow[node_id] = dict(template[node_id], inputs=dict(template[node_id]["inputs"], **inputs))
+        return workflow
+
     def update_workflow_with_text(self, pos, text):
-        self.workflow[f"{pos}"]["inputs"]["text"] = text
+        """ changes the default text of a node of the template """
+        with self._lock:
+            template = dict(self._template)
+            template[f"{pos}"] = dict(template[f"{pos}"], inputs=dict(template[f"{pos}"]["inputs"], text=text))
+            self._set_template(template)
 
     def run_prompts(self, prompts, size=(400,400), im_number=1, shift=3.10, steps=30, cfg=5):
         """
@@ -81,42 +627,817 @@ class ArtDesignClient:
             steps: number of steps for the diffusion process
             cfg: Set cfg to 1.0 for a speed boost at the cost of consistency. Samplers like res_multistep work pretty well at cfg 1.0.
                 The official number of steps is 50 but I think that's too much. Even just 10 steps seems to work.
+            All the prompts are queued up front on a single websocket so that ComfyUI never waits for the next one.
         """
+        results = dict(self.iter_prompts(list(enumerate(prompts)), size=size, im_number=im_number, shift=shift, steps=steps, cfg=cfg, save=False))
+        images_out = []
+        for idx in range(len(prompts)):
+            for image_data in results[idx]:
+                image = Image.open(io.BytesIO(image_data))
+                images_out.append(image)
+        return images_out
 
-        self.workflow["58"]["inputs"]["width"] = size[0]
-        self.workflow["58"]["inputs"]["height"] = size[1]
-        self.workflow["58"]["inputs"]["batch_size"] = im_number
-        self.workflow["66"]["inputs"]["shift"] = shift
-        self.workflow["3"]["inputs"]["steps"] = steps
-        self.workflow["3"]["inputs"]["cfg"] = cfg
+    def iter_workflows(self, jobs):
+        """
+            jobs format: [(job_id, workflow), ...], all queued up front (the ones in the cache are not sent)
+            yields (job_id, [png bytes, ...]) as soon as each job is done
+            If the iteration stops early (websocket dropped, generator closed), the unfinished prompts are cancelled on
+            ComfyUI: a new websocket has another client_id and would never get their results.
+        """
+        to_queue = []
+        for job_id, workflow in jobs:
+            key = ArtCache.key(workflow) if self.cache is not None else None
+            images = self.cache.get(key) if key is not None else None
+            if images is not None:
+                yield job_id, [image_data for node_id in images for image_data in images[node_id]]
+            else:
+                to_queue.append((job_id, key, workflow))
+        if not to_queue:
+            return
 
-        images_out = []
-        for prompt_txt in prompts:
-            self.workflow["6"]["inputs"]["text"] = prompt_txt[0]
-            self.workflow["7"]["inputs"]["text"] = prompt_txt[1]
-            
-            ws = websocket.WebSocket()
-            ws.connect(f"ws://{self.server_address}/ws?clientId={self.client_id}")
-            images = self.get_images(ws, self.workflow)
-            ws.close()
+        ws, client_id = self.get_ws()
+        try:
+            queued = {}
+            requeued = collections.Counter()
+            for job_id, key, workflow in to_queue:
+                prompt_id = str(uuid.uuid4())
+                self.queue_prompt(workflow, prompt_id, label=job_id, client_id=client_id)
+                queued[prompt_id] = (job_id, key, workflow)
 
-            for node_id in images:
-                for image_data in images[node_id]:
-                    image = Image.open(io.BytesIO(image_data))
-                    images_out.append(image)
+            def requeue(prompt_id):
+                job_id, key, workflow = queued[prompt_id]
+                if requeued[job_id] >= self.max_requeue:
+                    return None
+                requeued[job_id] += 1
+                new_prompt_id = str(uuid.uuid4())
+                self.queue_prompt(workflow, new_prompt_id, label=job_id, client_id=client_id)
+                queued[new_prompt_id] = queued.pop(prompt_id)
+                return new_prompt_id
 
-        return images_out
+            for prompt_id, node_outputs in self.iter_finished(ws, list(queued), requeue=requeue):
+                job_id, key, _ = queued.pop(prompt_id)
+                if node_outputs is None:   # cancelled for good
+                    yield job_id, []
+                    continue
+                images = self.download_images(prompt_id, node_outputs)
+                if self.cache is not None and any(images.values()):
+                    self.cache.put(key, images)
+                yield job_id, [image_data for node_id in images for image_data in images[node_id]]
+        finally:
+            self.release_ws(ws)
+            # stopped early (websocket dropped, caller gone): the results of the prompts left would never be read
+            for prompt_id in queued:
+                try:
+                    self.cancel_prompt(prompt_id)
+                except OSError:
+                    break   # server unreachable, nothing more to cancel there
+
+    def iter_prompts(self, card_prompts, size=(400,400), im_number=1, shift=3.10, steps=30, cfg=5, save=True, out_dir=None):
+        """
+            streaming version of run_prompts
+            card_prompts format: [(card_id, (positive prompt, negative prompt)), ...], other parameters: see run_prompts
+            yields (card_id, [png bytes, ...]) as soon as each card is generated, the images are never decoded
+            save: if True, the png bytes are written as they are to out_dir/{card_id}.png ({card_id}_{i}.png if im_number > 1)
+            out_dir: defaults to lib/artdesign/cards
+        """
+        if out_dir is None:
+            out_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cards")
+        if save:
+            os.makedirs(out_dir, exist_ok=True)
+
+        jobs = [(card_id, self.build_workflow(prompt_txt, size=size, im_number=im_number, shift=shift, steps=steps, cfg=cfg))
+                for card_id, prompt_txt in card_prompts]
+        for card_id, images_out in self.iter_workflows(jobs):
+            if save:
+                for i, image_data in enumerate(images_out):
+                    filename = f"{card_id}.png" if len(images_out) == 1 else f"{card_id}_{i}.png"
+                    with open(os.path.join(out_dir, filename), 'wb') as file:
+                        file.write(image_data)
+            yield card_id, images_out
 
 # Example usage:
 # client = ArtDesignClient()
 # prompts = ["masterpiece best quality man", "a man holding a panel with 'jordy love'"]
 # images_list = client.run_prompts(prompts)
+#
+# with ThreadPoolExecutor(4) as executor:   # one client shared by several threads
+#     batches = list(executor.map(lambda batch: client.run_prompts(batch, size=(624, 624)), prompt_batches))
+#
+# with ArtDesignClient(session=True) as client:   # one websocket for every run_prompts call
+#     images_list = client.run_prompts(prompts)
+#
+# client = ArtDesignClient(cache=ArtCache("art_cache", max_mb=4096))   # unchanged prompts are read back from disk
+# images_list = client.run_prompts(prompts)
+# client.cache.report()
+#
+# client = ArtDesignClient(ws_output=True)   # images come back on the websocket, no /history + /view round trips
+#
+# card_prompts = [(row["card_id"], (row["prompt"], row["negative_prompt"])) for row in cardpool.iter_rows(named=True)]
+# for card_id, images in client.iter_prompts(card_prompts, size=(816, 1110)):   # written to lib/artdesign/cards/{card_id}.png
+#     print(card_id)
+#
+# client = ArtDesignClient(timer=JobTimer())
+# images_list = client.run_prompts(prompts, steps=20)
+# client.timer.summary()   # mean queue wait / execution / download and seconds per node class_type
+# client.timer.to_csv("timings_steps20.csv")
+#
+# client = ArtDesignClient(job_timeout=300, max_requeue=1)   # a stuck job is cancelled and queued once more, then skipped
+
+
+class BatchScheduler:
+    """
+        runs prompts with mixed parameters: the submissions are ordered by (size, steps, cfg, shift) so that ComfyUI
+        reconfigures the latent and the sampler as little as possible, and the jobs with the same prompt and parameters
+        are merged into batch_size submissions (the workflow has one text per node, different prompts can't share a batch)
+    """
+    def __init__(self, client, max_batch=8):
+        """
+            client: ArtDesignClient used for the generation
+            max_batch: largest batch_size of a merged submission
+        """
+        self.client = client
+        self.max_batch = max_batch
+        self.jobs = []
+
+    def add(self, prompt_txt, size=(400,400), im_number=1, shift=3.10, steps=30, cfg=5):
+        """ same parameters as ArtDesignClient.run_prompts for one (positive prompt, negative prompt), returns the job index """
+        self.jobs.append({"prompt": tuple(prompt_txt), "size": tuple(size), "im_number": im_number, "shift": shift, "steps": steps, "cfg": cfg})
+        return len(self.jobs) - 1
+
+    def plan(self):
+        """ [(params, prompt, [(job index, im_number), ...]), ...] in submission order, each entry being one ComfyUI prompt """
+        groups = collections.OrderedDict()
+        for idx, job in enumerate(self.jobs):
+            params = (job["size"], job["steps"], job["cfg"], job["shift"])
+            groups.setdefault((params, job["prompt"]), []).append((idx, job["im_number"]))
+        submissions = []
+        for (params, prompt), members in sorted(groups.items(), key=lambda item: item[0][0]):
+            batch, batch_size = [], 0
+            for idx, im_number in members:
+                if batch and batch_size + im_number > self.max_batch:
+                    submissions.append((params, prompt, batch))
+                    batch, batch_size = [], 0
+                batch.append((idx, im_number))
+                batch_size += im_number
+            submissions.append((params, prompt, batch))
+        return submissions
+
+    def run(self):
+        """ returns [[PIL images], ...] in the order the jobs were added, then empties the scheduler """
+        submissions = self.plan()
+        workflows = []
+        for n, (params, prompt, batch) in enumerate(submissions):
+            size, steps, cfg, shift = params
+            batch_size = sum(im_number for _, im_number in batch)
+            workflows.append((n, self.client.build_workflow(prompt, size=size, im_number=batch_size, shift=shift, steps=steps, cfg=cfg)))
+
+        results = [[] for _ in self.jobs]
+        for n, images in self.client.iter_workflows(workflows):
+            start = 0
+            for idx, im_number in submissions[n][2]:
+                results[idx] = [Image.open(io.BytesIO(image_data)) for image_data in images[start:start + im_number]]
+                start += im_number
+        self.jobs = []
+        return results
+
+# Example usage:
+# scheduler = BatchScheduler(ArtDesignClient(), max_batch=6)
+# scheduler.add((icon_prompt, neg_prompt), size=(624, 624), im_number=6, steps=20)
+# scheduler.add((banner_prompt, neg_prompt), size=(1100, 250), im_number=6)
+# scheduler.add((icon_prompt_2, neg_prompt), size=(624, 624), im_number=6, steps=20)   # submitted right after the 1st one
+# icons_1, banners, icons_2 = scheduler.run()
+
+
+class PriorityArtQueue:
+    """
+        client side generation queue with priority classes: ComfyUI is only given feed_depth bulk prompts at a time, the
+        rest waits here, so an interactive prompt never waits behind the bulk backlog. Interactive prompts are sent at once
+        to the front of the ComfyUI queue: they start as soon as the running prompt is done.
+    """
+    PRIORITIES = {"interactive": 0, "bulk": 1}
+
+    def __init__(self, client, feed_depth=2):
+        """
+            client: ArtDesignClient used for the generation
+            feed_depth: bulk prompts queued on ComfyUI at the same time, 2 keeps the GPU busy while a result is downloaded
+        """
+        self.client = client
+        self.feed_depth = feed_depth
+        self.client_id = str(uuid.uuid4())
+        self.stats = {priority: {"jobs": 0, "wait_seconds": 0.0} for priority in self.PRIORITIES}
+        self._heap = []
+        self._seq = itertools.count()
+        self._in_flight = {}    # {prompt_id: (future, priority, submit time, cache key)}
+        self._outputs = {}
+        self._lock = threading.Lock()
+        self._closing = False
+        self._broken = None     # why the dispatcher stopped, once it did: every later submit fails with it
+        self._ws = client.connect(self.client_id)
+        self._ws.settimeout(0.1)
+        self._thread = threading.Thread(target=self._dispatch, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def submit(self, prompt_txt, priority="bulk", size=(400,400), im_number=1, shift=3.10, steps=30, cfg=5):
+        """
+            returns a concurrent.futures.Future of [png bytes, ...], parameters: see ArtDesignClient.run_prompts
+            once the dispatcher is gone (websocket closed, or close() called) the future fails with its ConnectionError
+        """
+        if priority not in self.PRIORITIES:
+            raise ValueError(f"priority must be one of {list(self.PRIORITIES)}")
+        future = concurrent.futures.Future()
+        workflow = self.client.build_workflow(prompt_txt, size=size, im_number=im_number, shift=shift, steps=steps, cfg=cfg)
+        key = ArtCache.key(workflow) if self.client.cache is not None else None
+        images = self.client.cache.get(key) if key is not None else None
+        if images is not None:
+            future.set_result([image_data for node_id in images for image_data in images[node_id]])
+            return future
+        with self._lock:
+            if self._broken is not None:
+                future.set_exception(self._broken)
+                return future
+            heapq.heappush(self._heap, (self.PRIORITIES[priority], next(self._seq), priority, workflow, key, future, time.time()))
+        return future
+
+    def run_prompts(self, prompts, priority="interactive", size=(400,400), im_number=1, shift=3.10, steps=30, cfg=5):
+        """ blocking helper for the notebooks: same output as ArtDesignClient.run_prompts """
+        futures = [self.submit(prompt_txt, priority=priority, size=size, im_number=im_number, shift=shift, steps=steps, cfg=cfg) for prompt_txt in prompts]
+        return [Image.open(io.BytesIO(image_data)) for future in futures for image_data in future.result()]
+
+    def pending(self):
+        """ {priority: prompts waiting client side} """
+        with self._lock:
+            counts = collections.Counter(entry[2] for entry in self._heap)
+        return {priority: counts.get(priority, 0) for priority in self.PRIORITIES}
+
+    def _feed(self):
+        """ sends the interactive prompts right away and tops ComfyUI up with bulk prompts """
+        while True:
+            with self._lock:
+                if not self._heap:
+                    return
+                rank, _, priority, workflow, key, future, submitted = self._heap[0]
+                bulk_in_flight = sum(1 for entry in self._in_flight.values() if entry[1] == "bulk")
+                if priority == "bulk" and bulk_in_flight >= self.feed_depth:
+                    return
+                heapq.heappop(self._heap)
+            if not future.set_running_or_notify_cancel():
+                continue
+            prompt_id = str(uuid.uuid4())
+            self._outputs[prompt_id] = {}
+            self._in_flight[prompt_id] = (future, priority, submitted, key)
+            try:
+                self.client.queue_prompt(workflow, prompt_id, label=priority, client_id=self.client_id, front=priority == "interactive")
+            except OSError as e:
+                del self._in_flight[prompt_id], self._outputs[prompt_id]
+                future.set_exception(e)
+
+    def _dispatch(self):
+        """ dispatcher thread: feeds ComfyUI and resolves the futures of the finished prompts """
+        try:
+            self._dispatch_loop()
+        except (websocket.WebSocketException, OSError) as e:
+            self._fail_all(ConnectionError(f"websocket closed: {e}"))
+        except Exception as e:   # a dead dispatcher must not leave futures nobody will resolve
+            self._fail_all(ConnectionError(f"dispatcher stopped: {type(e).__name__}: {e}"))
+            raise
+
+    def _fail_all(self, error):
+        """ fails the prompts in flight and waiting, and the later submits (with the first error if it already stopped) """
+        with self._lock:
+            if self._broken is None:
+                self._broken = error
+            futures = [entry[5] for entry in self._heap] + [entry[0] for entry in self._in_flight.values()]
+            self._heap = []
+            self._in_flight.clear()
+            self._outputs.clear()
+        for future in futures:
+            if not future.done():
+                future.set_exception(error)
+
+    def _dispatch_loop(self):
+        while not self._closing:
+            self._feed()
+            try:
+                out = self._ws.recv()
+            except websocket.WebSocketTimeoutException:
+                continue
+            try:
+                prompt_id = self.client.route_message(out, self._outputs)
+            except (ValueError, KeyError, TypeError, struct.error) as e:   # malformed frame: skip it, keep the queue alive
+                print(f"ignored a malformed websocket message: {type(e).__name__}: {e}")
+                continue
+            if prompt_id is None or prompt_id not in self._in_flight:
+                continue
+            future, priority, submitted, key = self._in_flight.pop(prompt_id)
+            try:
+                images = self.client.download_images(prompt_id, self._outputs.pop(prompt_id))
+            except OSError as e:
+                future.set_exception(e)
+                continue
+            if key is not None and any(images.values()):
+                self.client.cache.put(key, images)
+            self.stats[priority]["jobs"] += 1
+            self.stats[priority]["wait_seconds"] += time.time() - submitted
+            future.set_result([image_data for node_id in images for image_data in images[node_id]])
+
+    def report(self):
+        """ {priority: {"jobs", "mean_latency"}} from submit to result """
+        return {priority: {"jobs": stats["jobs"], "mean_latency": round(stats["wait_seconds"] / stats["jobs"], 3) if stats["jobs"] else None}
+                for priority, stats in self.stats.items()}
+
+    def close(self):
+        """
+            stops the dispatcher: the prompts still running on ComfyUI are cancelled there, their futures and the ones
+            still waiting client side fail with ConnectionError("queue closed"), like every later submit
+        """
+        self._closing = True
+        self._thread.join()
+        self._ws.close()
+        with self._lock:
+            in_flight = list(self._in_flight)
+        for prompt_id in in_flight:   # nobody reads their results any more
+            try:
+                self.client.cancel_prompt(prompt_id)
+            except OSError:
+                pass
+        self._fail_all(ConnectionError("queue closed"))
+
+# Example usage:
+# art_queue = PriorityArtQueue(ArtDesignClient(), feed_depth=2)
+# futures = [art_queue.submit(prompt, priority="bulk", size=(816, 1110)) for prompt in faction_prompts]   # background job
+# images_list = art_queue.run_prompts(icon_prompts, size=(624, 624), im_number=6)   # interactive: ~ one job of wait
+
+
+class AsyncArtDesignClient:
+    """ asyncio counterpart of ArtDesignClient: the blocking calls run in worker threads so other coroutines keep running """
+    def __init__(self, server_address="127.0.0.1:8000", max_in_flight=4, ws_output=False, timer=None):
+        """
+            max_in_flight: maximum number of prompts queued on ComfyUI at the same time by run_prompts
+            ws_output / timer: see ArtDesignClient
+        """
+        self.client = ArtDesignClient(server_address, ws_output=ws_output, timer=timer)
+        self.max_in_flight = max_in_flight
+        self.ws = None
+        self._loop = None
+        self._reader = None
+        self._outputs = {}   # {prompt_id: {node_id: [image info, ...]}} of the prompts being waited for
+        self._waiters = {}   # {prompt_id: asyncio.Future}
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def connect(self):
+        """ opens the websocket and starts the thread reading it """
+        if self.ws is not None and self.ws.connected:
+            return
+        self._loop = asyncio.get_running_loop()
+        self.ws = await asyncio.to_thread(self.client.connect)
+        self._reader = threading.Thread(target=self._read_ws, args=(self.ws,), daemon=True)
+        self._reader.start()
+
+    async def close(self):
+        if self.ws is not None:
+            ws, self.ws = self.ws, None
+            await asyncio.to_thread(ws.close)
+            await asyncio.to_thread(self._reader.join)
+
+    def _read_ws(self, ws):
+        """ reader thread: hands every message over to the event loop """
+        try:
+            while True:
+                out = ws.recv()
+                self._loop.call_soon_threadsafe(self._dispatch, out)
+        except (websocket.WebSocketException, OSError) as e:
+            self._loop.call_soon_threadsafe(self._fail_waiters, e)
+
+    def _dispatch(self, out):
+        prompt_id = self.client.route_message(out, self._outputs)
+        if prompt_id is not None:
+            waiter = self._waiters.pop(prompt_id)
+            if not waiter.done():
+                waiter.set_result(self._outputs.pop(prompt_id))
+
+    def _fail_waiters(self, error):
+        for prompt_id, waiter in list(self._waiters.items()):
+            if not waiter.done():
+                waiter.set_exception(ConnectionError(f"websocket closed while waiting for prompt {prompt_id}: {error}"))
+        self._waiters.clear()
+        self._outputs.clear()
+
+    async def queue_prompt(self, prompt, prompt_id):
+        await asyncio.to_thread(self.client.queue_prompt, prompt, prompt_id)
+
+    async def get_image(self, filename, subfolder, folder_type):
+        return await asyncio.to_thread(self.client.get_image, filename, subfolder, folder_type)
+
+    async def get_history(self, prompt_id):
+        return await asyncio.to_thread(self.client.get_history, prompt_id)
+
+    async def get_images(self, prompt):
+        """ queues one workflow and returns {node_id: [image bytes, ...]} once ComfyUI is done with it """
+        await self.connect()
+        prompt_id = str(uuid.uuid4())
+        self._outputs[prompt_id] = {}
+        self._waiters[prompt_id] = self._loop.create_future()
+        waiter = self._waiters[prompt_id]
+        try:
+            await self.queue_prompt(prompt, prompt_id)
+        except BaseException:
+            self._waiters.pop(prompt_id, None)
+            self._outputs.pop(prompt_id, None)
+            raise
+        node_outputs = await waiter
+        return await asyncio.to_thread(self.client.download_images, prompt_id, node_outputs)
+
+    async def run_prompts(self, prompts, size=(400,400), im_number=1, shift=3.10, steps=30, cfg=5):
+        """
+            async generator yielding (index in prompts, [PIL images]) in completion order
+            parameters: see ArtDesignClient.run_prompts, at most max_in_flight prompts are queued on ComfyUI at the same time
+        """
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        async def run_one(idx, prompt_txt):
+            async with semaphore:
+                workflow = self.client.build_workflow(prompt_txt, size=size, im_number=im_number, shift=shift, steps=steps, cfg=cfg)
+                images = await self.get_images(workflow)
+            images_out = await asyncio.to_thread(self._decode, images)
+            return idx, images_out
+
+        await self.connect()
+        tasks = [asyncio.ensure_future(run_one(idx, prompt_txt)) for idx, prompt_txt in enumerate(prompts)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def _decode(images):
+        images_out = []
+        for node_id in images:
+            for image_data in images[node_id]:
+                image = Image.open(io.BytesIO(image_data))
+                image.load()
+                images_out.append(image)
+        return images_out
+
+# Example usage:
+# async with AsyncArtDesignClient(max_in_flight=4) as client:
+#     async for idx, images in client.run_prompts(prompts, size=(816, 1110)):
+#         ...  # post-process while the next prompts are rendered
+
+
+class ArtDesignPool:
+    """ spreads the prompts over several ComfyUI servers, each prompt going to the least loaded one """
+    def __init__(self, servers, max_queue_depth=2, poll_interval=0.5, ws_output=False, timer=None):
+        """
+            servers: list of ComfyUI addresses, e.g. ["192.168.1.10:8188", "192.168.1.11:8188"]
+            max_queue_depth: a server is not given more prompts while its ComfyUI queue (running + pending, all
+                clients included) holds that many jobs. Keeping it low leaves the other prompts movable if a server drops.
+            poll_interval: seconds between two /queue polls when every server is full
+            ws_output / timer: see ArtDesignClient, one JobTimer can be shared by all the servers
+        """
+        self.clients = {server: ArtDesignClient(server, ws_output=ws_output, timer=timer) for server in servers}
+        self.max_queue_depth = max_queue_depth
+        self.poll_interval = poll_interval
+        self.stats = {server: self._empty_stats() for server in servers}
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _empty_stats():
+        return {"alive": False, "jobs": 0, "images": 0, "requeued": 0, "first_queued": None, "last_done": None}
+
+    def report(self):
+        """ per server throughput of the last run_prompts call """
+        report = {}
+        for server, stats in self.stats.items():
+            seconds = (stats["last_done"] - stats["first_queued"]) if stats["last_done"] else 0.0
+            report[server] = {
+                "alive": stats["alive"],
+                "jobs": stats["jobs"],
+                "images": stats["images"],
+                "requeued": stats["requeued"],
+                "seconds": round(seconds, 2),
+                "jobs_per_min": round(60 * stats["jobs"] / seconds, 2) if seconds > 0 else 0.0,
+            }
+        return report
+
+    def _queue_depths(self):
+        """ {server: jobs in its ComfyUI queue} for the servers alive, marking the unreachable ones as dropped """
+        depths = {}
+        for server, client in self.clients.items():
+            if not self.stats[server]["alive"]:
+                continue
+            try:
+                depth = client.get_queue_depth()
+            except OSError:
+                self._drop(server)
+                continue
+            with self._cond:
+                # the /queue answer may not list a prompt we just posted yet
+                depths[server] = max(depth, len(self._in_flight[server]))
+        return depths
+
+    def _drop(self, server):
+        """ marks a server as dropped and gives its unfinished prompts back to the dispatcher """
+        with self._cond:
+            if not self.stats[server]["alive"]:
+                return
+            self.stats[server]["alive"] = False
+            requeued = [idx for idx in self._in_flight[server].values() if self._results[idx] is None]
+            self._pending.extendleft(reversed(requeued))
+            self.stats[server]["requeued"] += len(requeued)
+            self._in_flight[server] = {}
+            self._cond.notify_all()
+
+    def _listen(self, server, ws):
+        """ listener thread of one server: routes its websocket messages and downloads the finished prompts """
+        client = self.clients[server]
+        outputs = self._outputs[server]
+        try:
+            while True:
+                out = ws.recv()
+                with self._cond:
+                    prompt_id = client.route_message(out, outputs)
+                    idx = self._in_flight[server].get(prompt_id) if prompt_id else None
+                if idx is None:
+                    continue
+                images = client.download_images(prompt_id, outputs.pop(prompt_id))
+                with self._cond:
+                    self._in_flight[server].pop(prompt_id, None)
+                    if self._results[idx] is None:
+                        self._results[idx] = images
+                        self._done += 1
+                        self.stats[server]["jobs"] += 1
+                        self.stats[server]["images"] += sum(len(images[node_id]) for node_id in images)
+                        self.stats[server]["last_done"] = time.time()
+                    self._cond.notify_all()
+        except (websocket.WebSocketException, OSError):
+            if not self._closing:
+                self._drop(server)
+
+    def _submit(self, server, idx):
+        prompt_id = str(uuid.uuid4())
+        with self._cond:
+            self._outputs[server][prompt_id] = {}
+            self._in_flight[server][prompt_id] = idx
+            if self.stats[server]["first_queued"] is None:
+                self.stats[server]["first_queued"] = time.time()
+        try:
+            self.clients[server].queue_prompt(self._workflows[idx], prompt_id)
+        except OSError:
+            self._drop(server)
+
+    def run_prompts(self, prompts, size=(400,400), im_number=1, shift=3.10, steps=30, cfg=5):
+        """
+            same parameters and output as ArtDesignClient.run_prompts, the prompts being spread over the servers
+            the prompts of a server that drops are moved to the remaining ones, see report() for the per server throughput
+        """
+        any_client = next(iter(self.clients.values()))
+        self._workflows = [any_client.build_workflow(prompt_txt, size=size, im_number=im_number, shift=shift, steps=steps, cfg=cfg) for prompt_txt in prompts]
+        self._results = [None] * len(prompts)
+        self._pending = collections.deque(range(len(prompts)))
+        self._in_flight = {server: {} for server in self.clients}
+        self._outputs = {server: {} for server in self.clients}
+        self._done = 0
+        self._closing = False
+        self.stats = {server: self._empty_stats() for server in self.clients}
+
+        sockets, listeners = {}, []
+        for server, client in self.clients.items():
+            try:
+                sockets[server] = client.connect()
+            except (websocket.WebSocketException, OSError):
+                continue
+            self.stats[server]["alive"] = True
+            listener = threading.Thread(target=self._listen, args=(server, sockets[server]), daemon=True)
+            listener.start()
+            listeners.append(listener)
+
+        try:
+            while True:
+                with self._cond:
+                    if self._done == len(prompts):
+                        break
+                    if not any(stats["alive"] for stats in self.stats.values()):
+                        raise ConnectionError(f"no ComfyUI server left, {len(prompts) - self._done} prompts not generated")
+                    has_pending = bool(self._pending)
+                if not has_pending:
+                    with self._cond:
+                        self._cond.wait(self.poll_interval)
+                    continue
+                depths = {server: depth for server, depth in self._queue_depths().items() if depth < self.max_queue_depth}
+                if not depths:
+                    with self._cond:
+                        self._cond.wait(self.poll_interval)
+                    continue
+                server = min(depths, key=depths.get)
+                with self._cond:
+                    if not self._pending:
+                        continue
+                    idx = self._pending.popleft()
+                self._submit(server, idx)
+        finally:
+            self._closing = True
+            for ws in sockets.values():
+                ws.close()
+            for listener in listeners:
+                listener.join()
+
+        images_out = []
+        for images in self._results:
+            for node_id in images:
+                for image_data in images[node_id]:
+                    images_out.append(Image.open(io.BytesIO(image_data)))
+        return images_out
+
+# Example usage:
+# pool = ArtDesignPool(["192.168.1.10:8188", "192.168.1.11:8188"])
+# images_list = pool.run_prompts(prompts, size=(816, 1110))
+# pool.report()   # {server: {"alive", "jobs", "images", "requeued", "seconds", "jobs_per_min"}}
+
+
+class ArtJobRunner:
+    """ resumable art generation of a whole cardpool parquet file, the finished cards are logged in an append-only manifest """
+    def __init__(self, client, parquet_path, prompt_column="prompt", negative_column="negative_prompt", manifest_path=None,
+                 out_dir=None, chunk_size=50, max_retries=5, backoff=5.0, max_backoff=300.0):
+        """
+            client: ArtDesignClient used for the generation
+            parquet_path: e.g. lib/cardpool/fac_Orcs.parquet, with a card_id column
+            prompt_column / negative_column: columns holding the positive / negative prompts
+            manifest_path: jsonl file of the job, defaults to <parquet name>_manifest.jsonl next to out_dir
+            out_dir: where the {card_id}.png files are written, defaults to lib/artdesign/cards
+            chunk_size: number of prompts queued at once, a crash costs at most one chunk
+            max_retries: attempts per card before it is logged as failed (it is retried on the next run)
+            backoff / max_backoff: seconds to wait after a failure, doubled at each consecutive failure
+        """
+        self.client = client
+        self.parquet_path = parquet_path
+        self.prompt_column = prompt_column
+        self.negative_column = negative_column
+        self.out_dir = out_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "cards")
+        self.manifest_path = manifest_path or os.path.join(
+            os.path.dirname(self.out_dir), f"{os.path.splitext(os.path.basename(parquet_path))[0]}_manifest.jsonl")
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def done_card_ids(self):
+        """ card_ids already generated according to the manifest """
+        done = set()
+        if not os.path.exists(self.manifest_path):
+            return done
+        with open(self.manifest_path, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # last line cut by a crash
+                if entry.get("status") == "done":
+                    done.add(entry["card_id"])
+        return done
+
+    def _log(self, **entry):
+        entry["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+        with open(self.manifest_path, 'a') as file:
+            file.write(json.dumps(entry) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    def todo(self):
+        """ [(card_id, (positive prompt, negative prompt)), ...] not generated yet """
+        cardpool = pl.read_parquet(self.parquet_path)
+        done = self.done_card_ids()
+        todo = []
+        for row in cardpool.iter_rows(named=True):
+            if row["card_id"] in done or not row[self.prompt_column]:
+                continue
+            todo.append((row["card_id"], (row[self.prompt_column], row.get(self.negative_column) or "")))
+        return todo
+
+    def run(self, size=(816, 1110), im_number=1, shift=3.10, steps=30, cfg=5):
+        """ generates every card missing from the manifest, returns {"done": n, "failed": [card_id, ...]} """
+        todo = collections.deque(self.todo())
+        attempts = collections.Counter()
+        failed = []
+        done = 0
+        consecutive_failures = 0
+        while todo:
+            chunk = [todo.popleft() for _ in range(min(self.chunk_size, len(todo)))]
+            remaining = dict(chunk)
+
+            def retry_later(card_id, error):
+                """ requeues a card, or logs it as failed once it used all its attempts """
+                attempts[card_id] += 1
+                if attempts[card_id] >= self.max_retries:
+                    self._log(card_id=card_id, status="failed", attempts=attempts[card_id], error=str(error))
+                    failed.append(card_id)
+                    return
+                todo.append((card_id, remaining[card_id]))
+
+            error, n_failed = None, 0
+            try:
+                for card_id, images in self.client.iter_prompts(chunk, size=size, im_number=im_number, shift=shift, steps=steps, cfg=cfg, out_dir=self.out_dir):
+                    if not images:   # execution error on ComfyUI's side
+                        retry_later(card_id, "no image returned")
+                        error, n_failed = "no image returned", n_failed + 1
+                    else:
+                        self._log(card_id=card_id, status="done", images=len(images))
+                        done += 1
+                        consecutive_failures = 0
+                    del remaining[card_id]
+            except (OSError, websocket.WebSocketException) as e:
+                self.client.close()
+                for card_id in list(remaining):
+                    retry_later(card_id, e)
+                error, n_failed = e, n_failed + len(remaining)
+            if error is not None:
+                # same backoff for a server that fails every job as for one that is unreachable
+                consecutive_failures += 1
+                if todo:
+                    wait = min(self.max_backoff, self.backoff * 2 ** (consecutive_failures - 1))
+                    print(f"{n_failed} cards requeued after error: {error}, retrying in {wait:.1f}s")
+                    time.sleep(wait)
+        return {"done": done, "failed": failed}
+
+# Example usage:
+# runner = ArtJobRunner(ArtDesignClient(session=True), "lib/cardpool/fac_Orcs.parquet")
+# runner.run(size=(816, 1110))   # run again after a crash, it restarts after the last finished card
+
+
+class SpriteCache:
+    """ in-memory LRU cache of processed PIL images (overlay sprites), shared by every card framed with a CardLayers """
+    def __init__(self, max_mb=256):
+        """ max_mb: memory cap of the decoded pixels, the least recently used sprites are evicted above it """
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.size_bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # {key: PIL image}, least recently used first
+
+    def get(self, key):
+        """ returns the image (shared: never modify it in place) or None """
+        with self._lock:
+            image = self._entries.get(key)
+            if image is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return image
+
+    def put(self, key, image):
+        with self._lock:
+            if key in self._entries:
+                self.size_bytes -= self._nbytes(self._entries.pop(key))
+            self._entries[key] = image
+            self.size_bytes += self._nbytes(image)
+            while self.size_bytes > self.max_bytes and len(self._entries) > 1:
+                _, old_image = self._entries.popitem(last=False)
+                self.size_bytes -= self._nbytes(old_image)
+                self.stats["evictions"] += 1
+        return image
+
+    @staticmethod
+    def _nbytes(image):
+        return image.width * image.height * len(image.getbands())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+
+    def report(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return dict(self.stats, entries=len(self._entries), size_mb=round(self.size_bytes / 1024 / 1024, 2),
+                    hit_rate=round(self.stats["hits"] / lookups, 3) if lookups else 0.0)
 
 
 class CardLayers:
     """ class to manage card layers """
-    def __init__(self):
+    ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cards_assets")
+    FONTS = {"Aladin": "Aladin-Regular.ttf", "Arial": "arial.ttf"}
+
+    def __init__(self, sprite_cache_mb=256, render_at_output=False):
+        """
+            sprite_cache_mb: memory cap of the processed overlays kept between cards, see self.sprites.report()
+            render_at_output: add_layer_to_a_card resizes the art to the card size before drawing the layers, see CardLayout
+        """
         self.layers = []
+        self.sprites = SpriteCache(max_mb=sprite_cache_mb)
+        self.render_at_output = render_at_output
 
     def round_corners(self, im, radius):
         mask = Image.new('L', im.size, 0)
@@ -147,7 +1468,21 @@ class CardLayers:
         position_pct: (x_pct, y_pct) where each is in [0,1] relative to base_image size
         resize_scale: scale factor for overlay image (relative to its original size)
         flip: if True, flip the overlay image horizontally
+        The processed overlay is cached (self.sprites) until the file changes on disk
         """
+        overlay_image = self.load_overlay(overlay_image_path, round_corners_radius=round_corners_radius, white_to_transp=white_to_transp,
+                                          resize_scale=resize_scale, rotate=rotate, flip=flip)
+        x = int(base_image.width * position_pct[0])
+        y = int(base_image.height * position_pct[1])
+        base_image.paste(overlay_image, (x, y), overlay_image)
+        return base_image
+
+    def load_overlay(self, overlay_image_path, round_corners_radius=None, white_to_transp=True, resize_scale=None, rotate=0, flip=False):
+        """ returns the overlay sprite as add_image_overlay pastes it, from the cache when possible (do not modify it) """
+        key = ("overlay", overlay_image_path, os.path.getmtime(overlay_image_path), resize_scale, rotate, flip, white_to_transp, round_corners_radius)
+        overlay_image = self.sprites.get(key)
+        if overlay_image is not None:
+            return overlay_image
         overlay_image = Image.open(overlay_image_path).convert('RGBA')
         if white_to_transp:
             overlay_image = self.white_to_transparent(overlay_image)
@@ -159,16 +1494,21 @@ class CardLayers:
             overlay_image = overlay_image.transpose(Image.FLIP_LEFT_RIGHT)
         if round_corners_radius:
             overlay_image = self.round_corners(overlay_image, radius=round_corners_radius)
-        x = int(base_image.width * position_pct[0])
-        y = int(base_image.height * position_pct[1])
-        base_image.paste(overlay_image, (x, y), overlay_image)
-        return base_image
+        return self.sprites.put(key, overlay_image)
 
-    def add_text_overlay(self, base_image, text, position_pct, color, font_size_pct=0.1, rotate=0):
-        font_size = int(base_image.width * font_size_pct)
-        font = ImageFont.truetype(r'..\cards_assets\Aladin-Regular.ttf', size=font_size)
-        x = int(base_image.width * position_pct[0])
-        y = int(base_image.height * position_pct[1])
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def get_font(font_type, font_size):
+        """ font_type: key of FONTS, one FreeTypeFont per (font, size) is loaded for the whole process """
+        return ImageFont.truetype(os.path.join(CardLayers.ASSETS_DIR, CardLayers.FONTS[font_type]), size=font_size)
+
+    def render_text(self, text, font_size, color, rotate=0, font_type='Aladin'):
+        """ returns the text sprite add_text_overlay centers on its position, cached in self.sprites (do not modify it) """
+        key = ("text", text, font_size, color, rotate, font_type)
+        text_img = self.sprites.get(key)
+        if text_img is not None:
+            return text_img
+        font = self.get_font(font_type, font_size)
         # Measure text size and offset
         dummy_img = Image.new('RGBA', (1, 1))
         dummy_draw = ImageDraw.Draw(dummy_img)
@@ -193,14 +1533,43 @@ class CardLayers:
             anchor="mm"
         )
         if rotate:
-            rotated_text = text_img.rotate(rotate, expand=True)
-            px = x - rotated_text.width // 2
-            py = y - rotated_text.height // 2
-            base_image.alpha_composite(rotated_text, dest=(px, py))
-        else:
-            base_image.alpha_composite(text_img, dest=(x - padded_w // 2, y - padded_h // 2))
+            text_img = text_img.rotate(rotate, expand=True)
+        return self.sprites.put(key, text_img)
+
+    def add_text_overlay(self, base_image, text, position_pct, color, font_size_pct=0.1, rotate=0, font_type='Aladin'):
+        """
+        position_pct: (x_pct, y_pct) of the text center, relative to base_image size
+        font_type: 'Aladin' (card texts) or 'Arial' (small print), see FONTS
+        """
+        font_size = int(base_image.width * font_size_pct)
+        text_img = self.render_text(text, font_size, color, rotate=rotate, font_type=font_type)
+        x = int(base_image.width * position_pct[0])
+        y = int(base_image.height * position_pct[1])
+        base_image.alpha_composite(text_img, dest=(x - text_img.width // 2, y - text_img.height // 2))
         return base_image
 
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def feather_mask(w, h, transp_edge_percent, corner_radius):
+        """
+            'L' mask of a (w, h) region fading to transparent over transp_edge_percent of each side, with rounded corners
+            of corner_radius pixels (0: square). Memoised, every card of a layout uses the same shapes: do not modify it.
+        """
+        edge_x = int(w * transp_edge_percent)
+        edge_y = int(h * transp_edge_percent)
+        dx = np.minimum(np.arange(w), w - 1 - np.arange(w))
+        dy = np.minimum(np.arange(h), h - 1 - np.arange(h))
+        fx = np.minimum(1.0, dx / edge_x) if edge_x > 0 else np.ones(w)
+        fy = np.minimum(1.0, dy / edge_y) if edge_y > 0 else np.ones(h)
+        mask_np = np.outer(fy, fx).astype(np.float32)
+        mask = Image.fromarray((mask_np * 255).astype(np.uint8), mode='L')
+        if corner_radius > 0:
+            corner_mask = Image.new('L', (w, h), 0)
+            draw_mask = ImageDraw.Draw(corner_mask)
+            draw_mask.rounded_rectangle([0, 0, w, h], radius=corner_radius, fill=255)
+            mask = ImageChops.multiply(mask, corner_mask)
+        return mask
+
     def blur_region(self, im, x_pct, y_pct, w_pct, h_pct, gauss_radius=5, corner_radius_pct=0.1, transp_edge_percent=0.2):
         x = int(im.width * x_pct)
         y = int(im.height * y_pct)
@@ -208,24 +1577,7 @@ class CardLayers:
         h = int(im.height * h_pct)
         region = im.crop((x, y, x + w, y + h))
         blurred = region.filter(ImageFilter.GaussianBlur(radius=gauss_radius))
-        mask = Image.new('L', (w, h), 0)
-        mask_np = np.zeros((h, w), dtype=np.float32)
-        edge_x = int(w * transp_edge_percent)
-        edge_y = int(h * transp_edge_percent)
-        for i in range(h):
-            for j in range(w):
-                dx = min(j, w - 1 - j)
-                dy = min(i, h - 1 - i)
-                fx = min(1.0, dx / edge_x) if edge_x > 0 else 1.0
-                fy = min(1.0, dy / edge_y) if edge_y > 0 else 1.0
-                mask_np[i, j] = fx * fy
-        mask_np = (mask_np * 255).astype(np.uint8)
-        mask = Image.fromarray(mask_np, mode='L')
-        if corner_radius_pct > 0:
-            corner_mask = Image.new('L', (w, h), 0)
-            draw_mask = ImageDraw.Draw(corner_mask)
-            draw_mask.rounded_rectangle([0, 0, w, h], radius=int(im.width * corner_radius_pct), fill=255)
-            mask = ImageChops.multiply(mask, corner_mask)
+        mask = self.feather_mask(w, h, transp_edge_percent, int(im.width * corner_radius_pct) if corner_radius_pct > 0 else 0)
         blended = Image.composite(blurred, region, mask)
         im.paste(blended, (x, y))
         return im
@@ -236,23 +1588,7 @@ class CardLayers:
         w = int(im.width * w_pct)
         h = int(im.height * h_pct)
         overlay = Image.new('RGBA', (w, h), color)
-        mask_np = np.zeros((h, w), dtype=np.float32)
-        edge_x = int(w * transp_edge_percent)
-        edge_y = int(h * transp_edge_percent)
-        for i in range(h):
-            for j in range(w):
-                dx = min(j, w - 1 - j)
-                dy = min(i, h - 1 - i)
-                fx = min(1.0, dx / edge_x) if edge_x > 0 else 1.0
-                fy = min(1.0, dy / edge_y) if edge_y > 0 else 1.0
-                mask_np[i, j] = fx * fy
-        mask_np = (mask_np * 255).astype(np.uint8)
-        mask = Image.fromarray(mask_np, mode='L')
-        if corner_radius_pct > 0:
-            corner_mask = Image.new('L', (w, h), 0)
-            draw_mask = ImageDraw.Draw(corner_mask)
-            draw_mask.rounded_rectangle([0, 0, w, h], radius=int(im.width * corner_radius_pct), fill=255)
-            mask = ImageChops.multiply(mask, corner_mask)
+        mask = self.feather_mask(w, h, transp_edge_percent, int(im.width * corner_radius_pct) if corner_radius_pct > 0 else 0)
         region = im.crop((x, y, x + w, y + h))
         blended = Image.composite(overlay, region, mask)
         im.paste(blended, (x, y))
@@ -309,55 +1645,325 @@ class CardLayers:
 
         return final_image
 
-    def add_layer_to_a_card(self, imBase_path, faction, condition, effect):
-        """ NOT IMPLEMENTED YET """
-        blurring_radius = 12
-        imBase = Image.open(imBase_path).convert('RGBA')
-
-        # 0 - colored patches on the base image before blurring it (helping see numbers or markers/icons)
-        # imBase = color_region(imBase, 1, 60, 45, 45, color="#DFDFDF", corner_radius=10)
-        # imBase = color_triangle(imBase, -210, 400, int(200*1.8), int(120*1.8), color="#000000")
-
-        # 1 - blur first so that the layers comes on top
-        imBase = self.blur_region(imBase, 0.01, 0.01, 0.12, 0.23, gauss_radius=blurring_radius, corner_radius_pct=0.02, transp_edge_percent=0.0)   # (w start %, h start %, w %, h %) Blurring for top-left icons
-        imBase = self.blur_region(imBase, 0.05, 1-0.20-0.005, 0.90, 0.20, gauss_radius=blurring_radius, corner_radius_pct=0.05, transp_edge_percent=0.0)   # (w start %, h start %, w %, h %) Blurring for Condition / Effect
-        imBase = self.blur_region(imBase, 0.5-(0.15/2), 1-0.20-0.01-0.1, 0.15, 0.1, gauss_radius=blurring_radius, corner_radius_pct=0.03, transp_edge_percent=0.0)  # (w start %, h start %, w %, h %) Faction logo
-
-        # 2 - markers & texts
-        #   2.1 - Top left markers
-        imBase = self.add_image_overlay(imBase, r'lib\artdesign\cards_assets\marker_mana.png', (0.005, 0.01), round_corners_radius=None, white_to_transp=True, resize_scale=0.5)                 # Mana marker
-        imBase = self.add_text_overlay(imBase, '2', (0.005+0.065, 0.065), color="#FFFFFF", font_size_pct=0.05)                                                                       # Mana cost
-        imBase = self.add_text_overlay(imBase, '+2', (0.005+0.062+0.003, 0.135+0.003), color="#ffcb7d", font_size_pct=0.08)                                                          # Value number shadow
-        imBase = self.add_text_overlay(imBase, '+2', (0.005+0.062, 0.135), color="#000000", font_size_pct=0.08)                                                                      # Value number
-        imBase = self.add_image_overlay(imBase, r'lib\artdesign\cards_assets\marker_shield.png', (0.005+0.015, 0.162), round_corners_radius=None, white_to_transp=True, resize_scale=0.40, rotate=90)         # shield marker
-        imBase = self.add_text_overlay(imBase, '3', (0.073, 0.199), color='white', font_size_pct=0.05, rotate=90)                                                                                  # shield value
-        #   2.2 - Faction logo
-        imBase = self.add_image_overlay(imBase, r'lib\artdesign\cards_assets\logo_bears.png', (0.425, 0.685), round_corners_radius=None, white_to_transp=False, resize_scale=0.2)                 # Faction marker
-        #   2.3 - condition & effect
-        imBase = self.add_image_overlay(imBase, r'lib\artdesign\cards_assets\cond_night.png', (0.2, 0.82), round_corners_radius=0.0, white_to_transp=False, resize_scale=0.18)                 # effect
-        imBase = self.color_region(imBase, 0.5-(0.005/2), 0.81, 0.005, 0.12, color="#171717", corner_radius_pct=0.0, transp_edge_percent=0.15) # SEPARATOR
-        # imBase = add_image_overlay(imBase, r'..\cards_assets\marker_unstoppable.png', (0.6, 0.81), round_corners_radius=None, white_to_transp=False, resize_scale=0.11)                 # effect
-        imBase = self.add_image_overlay(imBase, r'lib\artdesign\cards_assets\effect_unstoppable.png', (0.6, 0.81), round_corners_radius=0.0, white_to_transp=False, resize_scale=0.24)                 # effect
-        #   2.4 - biomes
-        imBase = self.add_image_overlay(imBase, r'lib\artdesign\cards_assets\biome_mountain.png', (0.055, 0.94), round_corners_radius=None, white_to_transp=False, resize_scale=0.1)              # 1st biome
-        imBase = self.add_image_overlay(imBase, r'lib\artdesign\cards_assets\biome_jungle.png', (0.868, 0.94), round_corners_radius=None, white_to_transp=False, resize_scale=0.1)              # 1st biome
-        #   2.5 - card name banner & card name
-        imBase = self.color_region(imBase, ((1-0.73)/2), 1-0.05-0.01, 0.73, 0.05, color="#306E2B", corner_radius_pct=0.03, transp_edge_percent=0.0)    # Black banner -border-  under card name
-        imBase = self.color_region(imBase, 0.3/2, 1-0.05-0.01, 0.7, 0.05, color="#000000", corner_radius_pct=0.03, transp_edge_percent=0.0)    # Black banner under card name
-        imBase = self.add_text_overlay(imBase, 'Guardian Bear rock', (0.5, 1-0.032), color="#773F29", font_size_pct=0.05)   # card name
-
-        imBase = imBase.resize((816, 1110), Image.LANCZOS)
-        # imBase = self.round_corners(imBase, radius=15)   # Round the corners of the final card
-        imBase.save('im_layered_result.png')
-        # imBase.show()
+    def add_layer_to_a_card(self, imBase_path, faction, mana_cost, advancing, shield, condition, effect, effect_number, rare, name, id, out_dir=None):
+        """
+            frames one card with the default layout (card_layout.json) and saves it as out_dir/{id}.png, plus its
+            derivatives (out_dir/thumb/{id}.webp, ...), recorded in the frame_cards manifest (<out_dir>_manifest.json)
+            like the cards framed in batch, which is where Utils.card_image finds them
+            out_dir: defaults to lib/artdesign/cards_framed
+        """
+        if getattr(self, '_layout', None) is None:
+            self._layout = CardLayout(layers=self, render_at_output=self.render_at_output)
+        card = {"faction": faction, "mana": mana_cost, "advancing": advancing, "shield": shield, "condition": condition,
+                "effect": effect, "effect_number": effect_number, "rare": rare, "name": name, "card_id": id}
+        out_dir = out_dir or os.path.join(os.path.dirname(os.path.abspath(__file__)), "cards_framed")
+        os.makedirs(out_dir, exist_ok=True)
+        im = self._layout.frame_card(imBase_path, card, out_path=os.path.join(out_dir, f"{id}.png"))
+        derivatives = self._layout.save_derivatives(im, out_dir, id)
+        from lib.artdesign.frame_cards import FrameManifest   # frame_cards imports this module
+        manifest = FrameManifest(f"{os.path.abspath(out_dir)}_manifest.json")
+        manifest.record(id, manifest.deps(dict(card, art_path=imBase_path), self._layout), derivatives)
+        manifest.save()
+        return im
+
+
+class CardLayout:
+    """
+        card frame described by a layout spec (card_layout.json): the layers drawn on the art, the condition / effect slots
+        picked per card, and the colours and sprites of each faction. The spec is compiled once per (base image size,
+        faction, rare) into a RenderPlan, every card of that kind then only runs the plan.
+
+        spec:
+            "palette" / "rare" / "factions": variables used as "$name" in the ops (rare overrides the faction ones)
+            "layers": ops drawn in order, {"op": "slot", "name": "condition"} draws slots.condition[card["condition"]]
+            ops (positions and sizes in fraction of the base image):
+                {"op": "tint", "rect": [x, y, w, h], "color", "transparency", "corner_radius"}   see transparent_colored_overlay
+                {"op": "blur", "rect", "radius", "corner_radius", "edge"}                       see blur_region
+                {"op": "color", "rect", "color", "corner_radius", "edge"}                       see color_region
+                {"op": "sprite", "path", "pos": [x, y], "scale", "rotate", "flip", "white_to_transp", "round_corners"}
+                {"op": "text", "text", "pos": [x, y] (center), "color", "size", "rotate", "font"}  "text" is formatted
+                    with the card fields, e.g. "ID: {card_id}"
+            "derivatives": smaller copies saved next to each framed card for the consumers that show it smaller,
+                {name: {"format": "WEBP" / "JPEG", "size": [w, h] or "size_mm": [w, h] + "dpi", "quality", "background"}},
+                see save_derivatives
+    """
+    DERIVATIVE_EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg", "PNG": "png"}
+
+    def __init__(self, spec_path=None, layers=None, assets_dir=None, render_at_output=False, derivatives=True):
+        """
+            spec_path: defaults to card_layout.json next to this file
+            layers: CardLayers whose sprite cache is used, a new one by default
+            assets_dir: folder of the sprites named in the spec, defaults to CardLayers.ASSETS_DIR
+            render_at_output: resize the art to output_size first and draw the layers at that size, instead of drawing
+                them on the full art and resizing the card at the end. Positions, rects and text sizes are fractions of
+                the card already, the pixel sizes (sprite scales, blur radii) are scaled by output width / art width.
+                Much less pixel work for big art (e.g. 1104x1472 -> 816x1110 is 1.8x fewer pixels), the text and
+                sprites are sharper and the blurs slightly different: see check_render_size.py
+            derivatives: save_derivatives writes the "derivatives" of the spec (False: none)
+        """
+        self.spec_path = spec_path or os.path.join(os.path.dirname(os.path.abspath(__file__)), "card_layout.json")
+        with open(self.spec_path, 'r') as file:
+            self.spec = json.load(file)
+        self.layers = layers or CardLayers()
+        self.assets_dir = assets_dir or CardLayers.ASSETS_DIR
+        self.render_at_output = render_at_output
+        self.derivatives = self.spec.get("derivatives", {}) if derivatives else {}
+        self._plans = {}
+
+    def palette(self, faction, rare=False):
+        if faction not in self.spec["factions"]:
+            raise ValueError(f"no layout for faction '{faction}', known: {list(self.spec['factions'])}")
+        palette = dict(self.spec.get("palette", {}), **self.spec["factions"][faction])
+        if rare:
+            palette.update(self.spec.get("rare", {}))
+        return palette
+
+    def card_ops(self, card):
+        """ the ops drawn on one card, slots expanded and "$" values resolved (texts still hold their {fields}) """
+        palette = self.palette(card["faction"], card.get("rare", False))
+        ops = []
+        for op in self.spec["layers"]:
+            if op["op"] == "slot":
+                cases = self.spec["slots"][op["name"]]
+                if card[op["name"]] not in cases:
+                    raise ValueError(f"no layout for {op['name']} '{card[op['name']]}', known: {list(cases)}")
+                ops.extend(cases[card[op["name"]]])
+            else:
+                ops.append(op)
+        return [{key: palette[value[1:]] if isinstance(value, str) and value.startswith('$') else value for key, value in op.items()} for op in ops]
+
+    def dependencies(self, card):
+        """
+            what the frame of a card depends on besides its art and row: {"layout": hash of its resolved ops and output
+            format, "assets": [sprite and font files used, relative to assets_dir]}
+        """
+        ops = self.card_ops(card)
+        layout = {"ops": ops, "output_size": self.spec.get("output_size"), "corner_radius": self.spec.get("corner_radius", 0)}
+        if self.render_at_output:
+            layout["render_at_output"] = True
+        if self.derivatives:
+            layout["derivatives"] = self.derivatives
+        assets = {op["path"] for op in ops if op["op"] == "sprite"} | {CardLayers.FONTS[op.get("font", "Aladin")] for op in ops if op["op"] == "text"}
+        return {"layout": hashlib.sha256(json.dumps(layout, sort_keys=True).encode('utf-8')).hexdigest()[:16], "assets": sorted(assets)}
+
+    def compile(self, base_size, faction, rare=False, pixel_scale=1.0):
+        """
+            returns the RenderPlan of the cards of that faction / rarity drawn on base_size (width, height) art
+            pixel_scale: factor of the sizes given in pixels (sprite scales, blur radii), for art resized by render_at_output
+        """
+        key = (tuple(base_size), faction, bool(rare), pixel_scale)
+        if key not in self._plans:
+            self._plans[key] = RenderPlan(self, key[0], self.palette(faction, rare), pixel_scale=pixel_scale)
+        return self._plans[key]
+
+    def render(self, base_image, card):
+        """ card: dict with the cardpool columns (faction, mana, advancing, shield, condition, effect, effect_number, rare, name, card_id) """
+        if base_image.mode not in ('RGB', 'RGBA'):
+            base_image = base_image.convert('RGBA')
+        pixel_scale = 1.0
+        output_size = tuple(self.spec.get("output_size", base_image.size))
+        if self.render_at_output and base_image.size != output_size:
+            # before the RGBA conversion: an RGB art resizes without the premultiplied alpha passes
+            pixel_scale = output_size[0] / base_image.width
+            base_image = base_image.resize(output_size, Image.LANCZOS)
+        base_image = base_image if base_image.mode == 'RGBA' else base_image.convert('RGBA')
+        return self.compile(base_image.size, card["faction"], card.get("rare", False), pixel_scale).execute(base_image, card)
+
+    def frame_card(self, art_path, card, out_path=None, **save_params):
+        """ frames the art file of one card, saved as out_path if given (save_params: e.g. compress_level=1, see PIL's save) """
+        im = self.render(Image.open(art_path), card)
+        if out_path:
+            im.save(out_path, **save_params)
+        return im
+
+    def derivative_path(self, out_dir, card_id, name):
+        """ out_dir/{name}/{card_id}.{ext}: served next to the framed card, e.g. /cards_framed/thumb/{card_id}.webp """
+        return os.path.join(out_dir, name, f"{card_id}.{self.DERIVATIVE_EXTENSIONS[self.derivatives[name]['format']]}")
+
+    def save_derivatives(self, im, out_dir, card_id):
+        """
+            saves the derivatives of the framed card im (RGBA, see "derivatives" in the spec) under out_dir
+            formats without alpha (JPEG) get the rounded corners flattened on their "background" colour
+            returns {name: {"path": relative to out_dir, "size": [w, h], "bytes"}}
+        """
+        saved = {}
+        for name, spec in self.derivatives.items():
+            if "size_mm" in spec:
+                size = tuple(round(mm / 25.4 * spec["dpi"]) for mm in spec["size_mm"])
+            else:
+                size = tuple(spec["size"])
+            derivative = im.resize(size, Image.LANCZOS) if size != im.size else im
+            save_params = {"quality": spec.get("quality", 90)}
+            if spec.get("dpi"):
+                save_params["dpi"] = (spec["dpi"], spec["dpi"])
+            if spec["format"] == "JPEG":
+                flat = Image.new('RGB', size, spec.get("background", "#000000"))
+                flat.paste(derivative, mask=derivative.getchannel('A'))
+                derivative = flat
+                save_params["optimize"] = True
+            path = self.derivative_path(out_dir, card_id, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{os.getpid()}")
+            derivative.save(tmp_path, format=spec["format"], **save_params)
+            os.replace(tmp_path, path)
+            saved[name] = {"path": os.path.relpath(path, out_dir).replace(os.sep, "/"), "size": list(size), "bytes": os.path.getsize(path)}
+        return saved
+
+
+class RenderPlan:
+    """ layout spec compiled for one base image size and palette: pixel rectangles, masks, sprites and fonts are ready """
+    def __init__(self, layout, base_size, palette, pixel_scale=1.0):
+        self.layout = layout
+        self.layers = layout.layers
+        self.base_size = base_size
+        self.palette = palette
+        self.pixel_scale = pixel_scale
+        self.output_size = tuple(layout.spec.get("output_size", base_size))
+        self.corner_radius = layout.spec.get("corner_radius", 0)
+        self.steps = self._compile_ops(layout.spec["layers"])
+        self.slots = {name: {case: self._compile_ops(ops) for case, ops in cases.items()}
+                      for name, cases in layout.spec.get("slots", {}).items()}
+        self._corner_mask = None
+        if self.corner_radius:
+            self._corner_mask = Image.new('L', self.output_size, 0)
+            ImageDraw.Draw(self._corner_mask).rounded_rectangle([0, 0, *self.output_size], radius=self.corner_radius, fill=255)
+
+    def _value(self, value):
+        """ "$name" values come from the palette """
+        if isinstance(value, str) and value.startswith('$'):
+            return self.palette[value[1:]]
+        return value
+
+    def _box(self, rect):
+        width, height = self.base_size
+        x_pct, y_pct, w_pct, h_pct = rect
+        return int(width * x_pct), int(height * y_pct), int(width * w_pct), int(height * h_pct)
+
+    def _compile_ops(self, ops):
+        width, height = self.base_size
+        steps = []
+        for op in ops:
+            kind = op["op"]
+            if kind == "slot":
+                steps.append(("slot", op["name"]))
+            elif kind in ("blur", "color"):
+                x, y, w, h = self._box(op["rect"])
+                corner_radius = int(width * op.get("corner_radius", 0)) if op.get("corner_radius", 0) > 0 else 0
+                mask = self.layers.feather_mask(w, h, op.get("edge", 0.0), corner_radius)
+                if kind == "blur":
+                    steps.append(("blur", (x, y, w, h), ImageFilter.GaussianBlur(radius=op.get("radius", 5) * self.pixel_scale), mask))
+                else:
+                    steps.append(("color", (x, y, w, h), Image.new('RGBA', (w, h), self._value(op["color"])), mask))
+            elif kind == "tint":
+                x, y, w, h = self._box(op["rect"])
+                color = ImageColor.getrgb(self._value(op["color"]))[:3]
+                alpha_value = int((1 - op.get("transparency", 20) / 100) * 255)
+                tint = Image.new('RGBA', (w, h), color + (alpha_value,))
+                if op.get("corner_radius", 0) > 0:
+                    corner_mask = Image.new('L', (w, h), 0)
+                    ImageDraw.Draw(corner_mask).rounded_rectangle([0, 0, w, h], radius=int(width * op["corner_radius"]), fill=255)
+                    tint_np = np.array(tint)
+                    tint_np[..., 3] = (tint_np[..., 3] * (np.array(corner_mask) / 255)).astype(np.uint8)
+                    tint = Image.fromarray(tint_np, mode='RGBA')
+                steps.append(("paste", (x, y), tint))
+            elif kind == "sprite":
+                scale, round_corners = op.get("scale"), op.get("round_corners")
+                if self.pixel_scale != 1:
+                    scale = (scale or 1) * self.pixel_scale
+                    round_corners = round_corners and max(1, round(round_corners * self.pixel_scale))
+                sprite = self.layers.load_overlay(os.path.join(self.layout.assets_dir, self._value(op["path"])),
+                                                  round_corners_radius=round_corners, white_to_transp=op.get("white_to_transp", False),
+                                                  resize_scale=scale, rotate=op.get("rotate", 0), flip=op.get("flip", False))
+                steps.append(("paste", (int(width * op["pos"][0]), int(height * op["pos"][1])), sprite))
+            elif kind == "text":
+                self.layers.get_font(op.get("font", "Aladin"), int(width * op["size"]))
+                steps.append(("text", (int(width * op["pos"][0]), int(height * op["pos"][1])), op["text"], int(width * op["size"]),
+                              self._value(op["color"]), op.get("rotate", 0), op.get("font", "Aladin")))
+            else:
+                raise ValueError(f"unknown layout op '{kind}' in {self.layout.spec_path}")
+        return steps
+
+    def _run(self, im, steps, card):
+        for step in steps:
+            kind = step[0]
+            if kind == "paste":
+                im.paste(step[2], step[1], step[2])
+            elif kind == "text":
+                _, (x, y), text, font_size, color, rotate, font_type = step
+                text_img = self.layers.render_text(text.format(**card), font_size, color, rotate=rotate, font_type=font_type)
+                im.alpha_composite(text_img, dest=(x - text_img.width // 2, y - text_img.height // 2))
+            elif kind in ("blur", "color"):
+                _, (x, y, w, h), source, mask = step
+                region = im.crop((x, y, x + w, y + h))
+                top = region.filter(source) if kind == "blur" else source
+                im.paste(Image.composite(top, region, mask), (x, y))
+            elif kind == "slot":
+                cases = self.slots[step[1]]
+                if card[step[1]] not in cases:
+                    raise ValueError(f"no layout for {step[1]} '{card[step[1]]}', known: {list(cases)}")
+                self._run(im, cases[card[step[1]]], card)
+
+    def execute(self, im, card):
+        """ draws the layers on im (RGBA of base_size, modified in place) and returns the final card """
+        self._run(im, self.steps, card)
+        if self.output_size != im.size:
+            im = im.resize(self.output_size, Image.LANCZOS)
+        if self._corner_mask is not None:
+            im.putalpha(self._corner_mask)
+        return im
+
+# Example usage:
+# layout = CardLayout()
+# for card in cardpool.iter_rows(named=True):
+#     layout.frame_card(f"lib/artdesign/cards/{card['card_id']}.png", card, out_path=f"lib/artdesign/cards_framed/{card['card_id']}.png")
+
 
 class Utils:
     """ class with utility functions """
-    
+    CARDS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'cards_framed'))
+    MANIFEST_PATH = f"{CARDS_DIR}_manifest.json"   # written by frame_cards
+    MANIFEST_CHECK_SECONDS = 1.0
+
+    def __init__(self):
+        self._derivatives = {}        # {card_id: {variant: {"path", "size", "bytes"}}} of the manifest
+        self._manifest_mtime = None
+        self._manifest_checked = 0.0
+
+    def _card_derivatives(self):
+        """ derivatives table of the frame_cards manifest, read again when the file changed (its mtime checked once a second at most) """
+        now = time.time()
+        if now - self._manifest_checked < self.MANIFEST_CHECK_SECONDS:
+            return self._derivatives
+        self._manifest_checked = now
+        try:
+            mtime = os.stat(self.MANIFEST_PATH).st_mtime_ns
+        except OSError:
+            self._derivatives, self._manifest_mtime = {}, None
+            return self._derivatives
+        if mtime != self._manifest_mtime:
+            try:
+                with open(self.MANIFEST_PATH, 'r') as file:
+                    self._derivatives = json.load(file).get("derivatives", {})
+            except (OSError, ValueError):
+                return self._derivatives   # being replaced, the next check reads it
+            self._manifest_mtime = mtime
+        return self._derivatives
+
+    def card_image(self, card_id, variant=None):
+        """
+            file of a framed card relative to cards_framed: the derivative variant ("thumb", "web", "print", see
+            CardLayout.save_derivatives) listed in the manifest, else the full size {card_id}.png
+        """
+        if variant:
+            derivative = self._card_derivatives().get(card_id, {}).get(variant)
+            if derivative:
+                return derivative["path"]
+        return f"{card_id}.png"
+
     def generate_pdf_from_deck(self, deck):
         """ will output a pdf file with all the cards in the deck (list of cards_ids) """
         # Get the image folder
-        cards_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'cards_framed'))
+        cards_dir = self.CARDS_DIR
         # PDF settings
         page_width, page_height = A4  # in points (1 pt = 1/72 inch)
         # Card size in mm
@@ -395,7 +2001,8 @@ class Utils:
         c.drawString(40, page_height - 40, instruction_text)
 
         for idx, card_id in enumerate(card_ids):        
-            img_path = os.path.join(cards_dir, f"{card_id}.png")
+            # 300 DPI jpeg: embedded as is, instead of decoding and recompressing the full png
+            img_path = os.path.join(cards_dir, self.card_image(card_id, "print"))
             col = idx % cols
             row = (idx // cols) % rows
             if idx > 0 and idx % (cols * rows) == 0:
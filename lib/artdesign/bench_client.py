@@ -0,0 +1,85 @@
+""" throughput benchmark of ArtDesignClient against the fake ComfyUI server, runs on any machine (no GPU)
+
+    python -m lib.artdesign.bench_client --latency 0.05 --prompts 32 --json bench_client.json
+"""
+import argparse
+import json
+import time
+
+from lib.artdesign import ArtDesignClient, JobTimer
+from lib.artdesign.fake_comfyui import FakeComfyUI
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def run_case(latency, n_prompts, im_number, image_size, mode, calls_per_prompt=False):
+    """
+        mode: "default" (one websocket per run_prompts call), "session" (one websocket for the client's lifetime) or
+            "session_ws" (session + images received on the websocket)
+        calls_per_prompt: if True, run_prompts is called once per prompt (the way the notebooks loop over the prompts)
+    """
+    with FakeComfyUI(latency=latency, image_size=image_size) as server:
+        timer = JobTimer()
+        client = ArtDesignClient(server.server_address, session=mode != "default", ws_output=mode == "session_ws", timer=timer)
+        prompts = [(f"benchmark prompt {i}", "") for i in range(n_prompts)]
+        start = time.time()
+        if calls_per_prompt:
+            images = [image for prompt in prompts for image in client.run_prompts([prompt], size=image_size, im_number=im_number)]
+        else:
+            images = client.run_prompts(prompts, size=image_size, im_number=im_number)
+        wall = time.time() - start
+        client.close()
+        busy = server.stats["busy_seconds"]
+    latencies = [record["total"] for record in timer.records() if record["total"] is not None]
+    return {
+        "mode": mode,
+        "calls": "per prompt" if calls_per_prompt else "one call",
+        "prompts": n_prompts,
+        "im_number": im_number,
+        "images": len(images),
+        "wall_s": round(wall, 3),
+        "prompts_per_s": round(n_prompts / wall, 2),
+        "p50_latency_s": round(percentile(latencies, 50), 3),
+        "p99_latency_s": round(percentile(latencies, 99), 3),
+        # time the fake GPU sat idle because of the client, per prompt
+        "client_overhead_ms": round(1000 * max(0.0, wall - busy) / n_prompts, 2),
+        "http_connections": client.http.stats["connections"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ArtDesignClient throughput benchmark")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per job on the fake server")
+    parser.add_argument("--prompts", type=int, nargs="+", default=[1, 8, 32], help="prompts per run")
+    parser.add_argument("--im-number", type=int, nargs="+", default=[1, 4], help="batch_size of each prompt")
+    parser.add_argument("--image-size", type=int, nargs=2, default=[816, 1110], metavar=("WIDTH", "HEIGHT"))
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+
+    cases = []
+    for n_prompts in args.prompts:
+        for im_number in args.im_number:
+            cases.append((n_prompts, im_number, "default", True))
+            for mode in ("default", "session", "session_ws"):
+                cases.append((n_prompts, im_number, mode, False))
+
+    results = []
+    columns = ["mode", "calls", "prompts", "im_number", "images", "wall_s", "prompts_per_s", "p50_latency_s", "p99_latency_s", "client_overhead_ms", "http_connections"]
+    print(" | ".join(f"{column:>18}" for column in columns))
+    for n_prompts, im_number, mode, calls_per_prompt in cases:
+        result = run_case(args.latency, n_prompts, im_number, tuple(args.image_size), mode, calls_per_prompt)
+        results.append(result)
+        print(" | ".join(f"{str(result[column]):>18}" for column in columns))
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"latency": args.latency, "image_size": args.image_size, "results": results}, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,224 @@
+""" benchmark of the CardLayers primitives and of the whole card framing, on synthetic art with the real cards_assets
+
+    python -m lib.artdesign.bench_layers --save-baseline bench_layers_baseline.json
+    python -m lib.artdesign.bench_layers --baseline bench_layers_baseline.json      # flags what got slower or bigger
+
+    every case runs in a fresh process: "cold_ms" is its first call (sprites, fonts and plans not cached yet),
+    "p50_ms" / "min_ms" the calls after it, "peak_mb" the memory taken at the peak of the first call (caches included,
+    see PeakMemory)
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from lib.artdesign import CardLayers, CardLayout
+from lib.artdesign.bench_client import percentile
+
+CARD = {"card_id": "Dwa23_035b16", "faction": "Dwarves", "mana": 2, "advancing": 3, "shield": 3, "condition": "biome_Dwa",
+        "effect": "advancing", "effect_number": 1, "rare": False, "name": "Yorik Brok"}
+LOGO = os.path.join(CardLayers.ASSETS_DIR, "logo_dwarves.png")
+
+
+def synthetic_art(width, height, seed=0):
+    """ RGB art with smooth shapes and grain (blur and png costs depend on the content: not a flat colour, not pure noise) """
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    channels = []
+    for _ in range(3):
+        fx, fy, phase = rng.uniform(2, 9, 2).tolist() + [rng.uniform(0, 6.3)]
+        channels.append(128 + 60 * np.sin(x / width * fx + phase) * np.cos(y / height * fy) + 40 * (x + y) / (width + height))
+    pixels = np.stack(channels, axis=2) + rng.normal(0, 12, (height, width, 3))
+    return Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+
+
+def rss_mb():
+    """ resident memory of this process, in MB (None where it is not known) """
+    if os.path.exists("/proc/self/statm"):
+        with open("/proc/self/statm", "r") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD), ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t), ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t), ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t), ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.WorkingSetSize / 2 ** 20
+    return None
+
+
+class PeakMemory:
+    """
+        with PeakMemory() as peak: ...   then peak.mb: how far the resident memory rose above its level at the start.
+        Exact on Linux (the kernel's high-water mark is reset, then read), elsewhere sampled every 0.5 ms by a thread.
+    """
+    def __init__(self):
+        self.mb = None
+        self._samples = []
+        self._done = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._start = rss_mb()
+        try:
+            with open("/proc/self/clear_refs", "w") as file:
+                file.write("5")   # resets VmHWM
+        except OSError:
+            if self._start is not None:
+                self._thread = threading.Thread(target=self._sample, daemon=True)
+                self._thread.start()
+        return self
+
+    def _sample(self):
+        while not self._done.wait(0.0005):
+            self._samples.append(rss_mb())
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._start is None:
+            return
+        if self._thread is None:
+            with open("/proc/self/status", "r") as file:
+                peak = next(int(line.split()[1]) / 1024 for line in file if line.startswith("VmHWM:"))
+        else:
+            self._done.set()
+            self._thread.join()
+            peak = max(self._samples + [rss_mb()])
+        self.mb = max(0.0, peak - self._start)
+
+
+# region cases: each builds the call to time from (CardLayers, RGBA art, temporary folder)
+def _render(**options):
+    def case(layers, art, tmp_dir):
+        layout = CardLayout(layers=layers, **options)
+        return lambda: layout.render(art.copy(), CARD)
+    return case
+
+
+def _add_layer_to_a_card(layers, art, tmp_dir):
+    art_path = os.path.join(tmp_dir, f"{CARD['card_id']}.png")
+    art.convert('RGB').save(art_path, compress_level=1)
+    return lambda: layers.add_layer_to_a_card(art_path, CARD["faction"], CARD["mana"], CARD["advancing"], CARD["shield"], CARD["condition"],
+                                              CARD["effect"], CARD["effect_number"], CARD["rare"], CARD["name"], CARD["card_id"],
+                                              out_dir=os.path.join(tmp_dir, "framed"))
+
+
+CASES = {
+    # the primitives, with the parameters of card_layout.json (bottom band, logo, name)
+    "blur_region": lambda layers, art, tmp_dir: lambda: layers.blur_region(art, 0.05, 0.795, 0.9, 0.2, gauss_radius=8, corner_radius_pct=0.05,
+                                                                           transp_edge_percent=0.0),
+    "color_region": lambda layers, art, tmp_dir: lambda: layers.color_region(art, 0.08, 0.94, 0.84, 0.05, color="#236CA5",
+                                                                             corner_radius_pct=0.03, transp_edge_percent=0.0),
+    "transparent_colored_overlay": lambda layers, art, tmp_dir: lambda: layers.transparent_colored_overlay(art, 0.05, 0.795, 0.9, 0.2,
+                                                                                                           transparency_percent=40, color=(0, 0, 0),
+                                                                                                           corner_radius_pct=0.05),
+    "add_image_overlay": lambda layers, art, tmp_dir: lambda: layers.add_image_overlay(art, LOGO, (0.425, 0.685), resize_scale=0.2),
+    "add_text_overlay": lambda layers, art, tmp_dir: lambda: layers.add_text_overlay(art, CARD["name"], (0.5, 0.965), "#236CA5", font_size_pct=0.05),
+    "white_to_transparent": lambda layers, art, tmp_dir: lambda: layers.white_to_transparent(art),
+    # whole cards
+    "card: add_layer_to_a_card": _add_layer_to_a_card,   # render + png + derivatives + manifest
+    "card: render": _render(),
+    "card: render at output": _render(render_at_output=True),
+}
+# endregion
+
+
+def run_case(name, size, repeat):
+    """ runs in a fresh process, returns {"case", "size", "cold_ms", "p50_ms", "min_ms", "peak_mb"}, repeat >= 1 """
+    if repeat < 1:
+        raise ValueError(f"repeat must be at least 1, not {repeat}")
+    tmp_dir = tempfile.mkdtemp(prefix="bench_layers_")
+    try:
+        art = synthetic_art(*size).convert('RGBA')
+        call = CASES[name](CardLayers(), art, tmp_dir)
+        with PeakMemory() as peak:   # warm calls mostly reuse the memory the first one took: it is the one to watch
+            start = time.perf_counter()
+            call()
+            cold_ms = 1000 * (time.perf_counter() - start)
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            call()
+            times.append(1000 * (time.perf_counter() - start))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return {"case": name, "size": f"{size[0]}x{size[1]}", "cold_ms": round(cold_ms, 2), "p50_ms": round(percentile(times, 50), 2),
+            "min_ms": round(min(times), 2), "peak_mb": None if peak.mb is None else round(peak.mb, 1)}
+
+
+def compare(result, baseline, tolerance=0.2, min_ms=0.5, min_mb=2.0):
+    """ "slower" / "memory" if the result is worse than its baseline beyond the tolerance (and the noise floors), "faster", "ok" or "new" """
+    base = baseline.get(f"{result['case']}@{result['size']}")
+    if base is None:
+        return "new"
+    # the fastest call is the least disturbed by the rest of the machine, p50 moves with the load
+    if result["min_ms"] > base["min_ms"] * (1 + tolerance) and result["min_ms"] - base["min_ms"] > min_ms:
+        return "slower"
+    if result["peak_mb"] is not None and base["peak_mb"] is not None and result["peak_mb"] > base["peak_mb"] * (1 + tolerance) + min_mb:
+        return "memory"
+    if result["min_ms"] < base["min_ms"] * (1 - tolerance) and base["min_ms"] - result["min_ms"] > min_ms:
+        return "faster"
+    return "ok"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CardLayers primitives and card framing benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[816, 1110, 1104, 1472], metavar="W H",
+                        help="art sizes, as width height pairs (card size and ComfyUI output by default)")
+    parser.add_argument("--cases", nargs="+", default=None, choices=list(CASES), metavar="CASE", help=f"subset of: {', '.join(CASES)}")
+    parser.add_argument("--repeat", type=int, default=10, help="timed calls per case after the cold one")
+    parser.add_argument("--baseline", default=None, help="results saved with --save-baseline, the regressions are flagged (exit code 1)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown / memory growth flagged as a regression")
+    parser.add_argument("--save-baseline", default=None, help="write the results to this file")
+    args = parser.parse_args()
+    if len(args.sizes) % 2:
+        parser.error("--sizes takes width height pairs")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1: p50_ms and min_ms come from the timed calls")
+    sizes = list(zip(args.sizes[::2], args.sizes[1::2]))
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = {f"{result['case']}@{result['size']}": result for result in json.load(file)["results"]}
+
+    results, regressions = [], []
+    columns = ["case", "size", "cold_ms", "p50_ms", "min_ms", "peak_mb", "status"]
+    print(" | ".join(f"{column:>26}" if column == "case" else f"{column:>10}" for column in columns))
+    for size in sizes:
+        for name in args.cases or CASES:
+            # a new process per case: cold caches, and a peak memory that only this case can raise
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                result = pool.submit(run_case, name, size, args.repeat).result()
+            result["status"] = compare(result, baseline, args.tolerance) if baseline else ""
+            if result["status"] in ("slower", "memory"):
+                regressions.append(result)
+            results.append(result)
+            print(" | ".join(f"{str(result[column]):>26}" if column == "case" else f"{str(result[column]):>10}" for column in columns))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({"machine": platform.platform(), "python": platform.python_version(), "repeat": args.repeat,
+                       "results": [{key: value for key, value in result.items() if key != "status"} for result in results]}, file, indent=2)
+    if regressions:
+        print(f"{len(regressions)} regressions against {args.baseline}: " + ", ".join(f"{r['case']}@{r['size']} ({r['status']})" for r in regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+""" side-by-side quality check of CardLayout(render_at_output=True) against the default full size rendering
+
+    python -m lib.artdesign.check_render_size --art-dir lib/artdesign/cards --cards 12
+    python -m lib.artdesign.check_render_size --art-size 1632 2220    # art upscaled 2x before framing
+
+    writes reference | at output size | difference x8 images to --out-dir and prints the time and PSNR of each card
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from lib.artdesign import CardLayout
+from lib.artdesign.frame_cards import HERE, find_jobs
+
+
+def psnr(a, b):
+    """ PSNR in dB of two uint8 arrays, None if they are identical """
+    mse = np.mean((a.astype(np.float64) - b.astype(np.float64)) ** 2)
+    return round(float(10 * np.log10(255 ** 2 / mse)), 2) if mse else None
+
+
+def side_by_side(reference, fast, gain=8):
+    """ reference | fast | absolute difference of the RGB channels times gain, on a grey background """
+    diff = np.abs(np.asarray(reference, dtype=np.int16)[..., :3] - np.asarray(fast, dtype=np.int16)[..., :3]).max(axis=2)
+    diff_image = Image.fromarray(np.minimum(diff * gain, 255).astype(np.uint8)).convert('RGBA')
+    width, height = reference.size
+    sheet = Image.new('RGBA', (3 * width, height), (128, 128, 128, 255))
+    for n, image in enumerate((reference, fast, diff_image)):
+        sheet.alpha_composite(image, dest=(n * width, 0))
+    return sheet
+
+
+def best_time(layout, art, card, repeat=3):
+    """ (framed card, best time in ms of repeat renders), plans, sprites and fonts are warmed first """
+    framed = layout.render(art.copy(), card)
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        layout.render(art.copy(), card)
+        times.append(1000 * (time.time() - start))
+    return framed, min(times)
+
+
+def check(art_dir=None, parquet_path=None, out_dir=None, n_cards=12, art_size=None, layout_path=None):
+    """
+        frames n_cards cards (spread over the card pool) both ways
+        art_size: (width, height) the art is resized to first, to try the upscaled sources (defaults to the art files' size)
+        returns [{"card_id", "art_size", "reference_ms", "at_output_ms", "psnr_db", "max_diff", "off_by_8"}, ...]
+    """
+    art_dir = art_dir or os.path.join(HERE, "cards")
+    parquet_path = parquet_path or os.path.join(HERE, "..", "cardpool", "cardpool.parquet")
+    out_dir = out_dir or os.path.join(HERE, "render_size_check")
+    os.makedirs(out_dir, exist_ok=True)
+    jobs, _, _ = find_jobs(art_dir, parquet_path)
+    jobs = jobs[::max(1, len(jobs) // n_cards)][:n_cards]
+    reference_layout = CardLayout(spec_path=layout_path)
+    fast_layout = CardLayout(spec_path=layout_path, render_at_output=True)
+
+    results = []
+    for card in jobs:
+        art = Image.open(card["art_path"])
+        art.load()
+        if art_size:
+            art = art.resize(tuple(art_size), Image.LANCZOS)
+        reference, reference_ms = best_time(reference_layout, art, card)
+        fast, at_output_ms = best_time(fast_layout, art, card)
+
+        a, b = np.asarray(reference), np.asarray(fast)
+        visible = a[..., 3] > 0
+        diff = np.abs(a[..., :3].astype(np.int16) - b[..., :3].astype(np.int16)).max(axis=2)[visible]
+        side_by_side(reference, fast).save(os.path.join(out_dir, f"{card['card_id']}.png"), compress_level=1)
+        results.append({"card_id": card["card_id"], "art_size": list(art.size), "reference_ms": round(reference_ms, 1),
+                        "at_output_ms": round(at_output_ms, 1), "psnr_db": psnr(a[visible][:, :3], b[visible][:, :3]),
+                        "max_diff": int(diff.max()), "off_by_8": round(float((diff > 8).mean()), 4)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compares the cards framed at art size and at output size")
+    parser.add_argument("--art-dir", default=None, help="generated art ({card_id}.png), defaults to lib/artdesign/cards")
+    parser.add_argument("--parquet", default=None, help="card pool, defaults to lib/cardpool/cardpool.parquet")
+    parser.add_argument("--out-dir", default=None, help="side-by-side images, defaults to lib/artdesign/render_size_check")
+    parser.add_argument("--cards", type=int, default=12, help="number of cards compared")
+    parser.add_argument("--art-size", type=int, nargs=2, default=None, metavar=("WIDTH", "HEIGHT"), help="resize the art to this size first")
+    parser.add_argument("--layout", default=None, help="layout spec, defaults to lib/artdesign/card_layout.json")
+    parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = parser.parse_args()
+    results = check(art_dir=args.art_dir, parquet_path=args.parquet, out_dir=args.out_dir, n_cards=args.cards, art_size=args.art_size,
+                    layout_path=args.layout)
+
+    columns = ["card_id", "art_size", "reference_ms", "at_output_ms", "psnr_db", "max_diff", "off_by_8"]
+    print(" | ".join(f"{column:>14}" for column in columns))
+    for result in results:
+        print(" | ".join(f"{str(result[column]):>14}" for column in columns))
+    if results:
+        reference_ms = sum(result["reference_ms"] for result in results)
+        at_output_ms = sum(result["at_output_ms"] for result in results)
+        psnrs = [result["psnr_db"] for result in results if result["psnr_db"] is not None]
+        print(f"speedup {reference_ms / at_output_ms:.2f}x, min PSNR {min(psnrs) if psnrs else None} dB")
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
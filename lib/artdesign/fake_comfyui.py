@@ -0,0 +1,311 @@
+""" in-process stand-in for a ComfyUI server (/prompt, /ws, /history, /view, /queue, /interrupt), no GPU needed """
+import argparse
+import base64
+import hashlib
+import io
+import json
+import queue
+import struct
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from PIL import Image
+
+WS_MAGIC = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+class FakeComfyUI:
+    """
+        runs the prompts one at a time like ComfyUI, sending the same websocket messages
+        (execution_start, executing, progress, executed, execution_interrupted) and serving the images on /view,
+        or as binary frames if the workflow uses SaveImageWebsocket
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0.5, steps=5, image_size=None, send_previews=True):
+        """
+            port: 0 picks a free port, see self.server_address
+            latency: seconds spent on each job (split over the sampler steps)
+            steps: number of progress messages sent per job
+            image_size: (width, height) of the images returned, defaults to the size asked in node 58
+            send_previews: also send a binary latent preview frame at each step, as ComfyUI does
+        """
+        self.latency = latency
+        self.steps = steps
+        self.image_size = image_size
+        self.send_previews = send_previews
+        self.history = {}
+        self.files = {}
+        self.stats = {"jobs": 0, "images": 0, "busy_seconds": 0.0}
+        self._pending = []           # jobs waiting, in queue order
+        self._running = None         # prompt_id being executed
+        self._interrupted = set()
+        self._sockets = {}           # {client_id: handler}
+        self._pngs = {}              # {(width, height, idx): png bytes}, noise images encoded once
+        self._lock = threading.Lock()
+        self._wakeup = queue.Queue()
+        self._stopped = False
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self.server_address = f"{host}:{self.httpd.server_address[1]}"
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        threading.Thread(target=self._worker, daemon=True).start()
+        return self
+
+    def stop(self):
+        """ shuts the server down and drops every websocket, like a ComfyUI crash seen from the client """
+        self._stopped = True
+        self._wakeup.put(None)
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.drop_websockets()
+
+    def drop_websockets(self):
+        """ closes every websocket while the server keeps running, like a network drop between the client and ComfyUI """
+        with self._lock:
+            handlers = list(self._sockets.values())
+            self._sockets.clear()
+        for handler in handlers:
+            try:
+                handler.connection.shutdown(2)
+                handler.connection.close()
+            except OSError:
+                pass
+
+    # region queue
+    def queue_depth(self):
+        with self._lock:
+            return len(self._pending) + (1 if self._running else 0)
+
+    def _add_job(self, body):
+        prompt_id = body.get("prompt_id") or str(uuid.uuid4())
+        with self._lock:
+            job = {"prompt_id": prompt_id, "prompt": body["prompt"], "client_id": body.get("client_id")}
+            if body.get("front"):
+                self._pending.insert(0, job)
+            else:
+                self._pending.append(job)
+        self._wakeup.put(prompt_id)
+        return prompt_id
+
+    def _queue_listing(self):
+        with self._lock:
+            running = [[0, self._running, {}, {}, []]] if self._running else []
+            pending = [[n + 1, job["prompt_id"], {}, {}, []] for n, job in enumerate(self._pending)]
+        return {"queue_running": running, "queue_pending": pending}
+
+    def _delete(self, prompt_ids):
+        with self._lock:
+            self._pending = [job for job in self._pending if job["prompt_id"] not in prompt_ids]
+
+    def _interrupt(self, prompt_id=None):
+        with self._lock:
+            if self._running and (prompt_id is None or prompt_id == self._running):
+                self._interrupted.add(self._running)
+    # endregion
+
+    # region execution
+    def _png(self, width, height, idx):
+        key = (width, height, idx)
+        if key not in self._pngs:
+            rng = np.random.default_rng(idx)
+            pixels = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+            buffer = io.BytesIO()
+            Image.fromarray(pixels).save(buffer, format="PNG", compress_level=1)
+            self._pngs[key] = buffer.getvalue()
+        return self._pngs[key]
+
+    def _worker(self):
+        while not self._stopped:
+            self._wakeup.get()
+            while not self._stopped:
+                with self._lock:
+                    if not self._pending:
+                        break
+                    job = self._pending.pop(0)
+                    self._running = job["prompt_id"]
+                start = time.time()
+                self._execute(job)
+                with self._lock:
+                    self._running = None
+                    self.stats["busy_seconds"] += time.time() - start
+
+    def _execute(self, job):
+        prompt_id, client_id, workflow = job["prompt_id"], job["client_id"], job["prompt"]
+        self._send_json(client_id, "execution_start", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)})
+        sampler = next((node_id for node_id, node in workflow.items() if node["class_type"] == "KSampler"), None)
+        self._send_json(client_id, "executing", {"node": sampler, "display_node": sampler, "prompt_id": prompt_id})
+        for step in range(self.steps):
+            time.sleep(self.latency / max(1, self.steps))
+            if prompt_id in self._interrupted:
+                self._interrupted.discard(prompt_id)
+                self._send_json(client_id, "execution_interrupted", {"prompt_id": prompt_id, "node_id": sampler})
+                self.history[prompt_id] = {"prompt": [0, prompt_id, workflow, {}, []], "outputs": {}, "status": {"status_str": "error", "completed": False}}
+                return
+            self._send_json(client_id, "progress", {"value": step + 1, "max": self.steps, "prompt_id": prompt_id, "node": sampler})
+            if self.send_previews:
+                self._send_frame(client_id, 0x2, struct.pack(">II", 1, 1) + b"\xff\xd8 latent preview")
+
+        latent = next((node for node in workflow.values() if node["class_type"] == "EmptySD3LatentImage"), {"inputs": {}})
+        width, height = self.image_size or (latent["inputs"].get("width", 64), latent["inputs"].get("height", 64))
+        images = [self._png(width, height, idx) for idx in range(latent["inputs"].get("batch_size", 1))]
+
+        outputs = {}
+        for node_id, node in workflow.items():
+            if node["class_type"] == "SaveImageWebsocket":
+                self._send_json(client_id, "executing", {"node": node_id, "display_node": node_id, "prompt_id": prompt_id})
+                for image_data in images:
+                    self._send_frame(client_id, 0x2, struct.pack(">II", 1, 2) + image_data)
+            elif node["class_type"] == "SaveImage":
+                self._send_json(client_id, "executing", {"node": node_id, "display_node": node_id, "prompt_id": prompt_id})
+                infos = []
+                for image_data in images:
+                    filename = f"ComfyUI_{uuid.uuid4().hex[:8]}_.png"
+                    self.files[filename] = image_data
+                    infos.append({"filename": filename, "subfolder": "", "type": "output"})
+                outputs[node_id] = {"images": infos}
+                self._send_json(client_id, "executed", {"node": node_id, "display_node": node_id, "output": {"images": infos}, "prompt_id": prompt_id})
+        self.history[prompt_id] = {"prompt": [0, prompt_id, workflow, {}, []], "outputs": outputs, "status": {"status_str": "success", "completed": True}}
+        self.stats["jobs"] += 1
+        self.stats["images"] += len(images)
+        self._send_json(client_id, "execution_success", {"prompt_id": prompt_id, "timestamp": int(time.time() * 1000)})
+        self._send_json(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+    # endregion
+
+    # region websocket
+    def _send_json(self, client_id, message_type, data):
+        self._send_frame(client_id, 0x1, json.dumps({"type": message_type, "data": data}).encode("utf-8"))
+
+    def _send_frame(self, client_id, opcode, payload):
+        with self._lock:
+            handler = self._sockets.get(client_id)
+        if handler is None:
+            return
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        with handler.write_lock:
+            try:
+                handler.wfile.write(header + payload)
+                handler.wfile.flush()
+            except (OSError, ValueError):
+                pass
+
+    def _serve_ws(self, handler, client_id):
+        accept = base64.b64encode(hashlib.sha1((handler.headers["Sec-WebSocket-Key"] + WS_MAGIC).encode()).digest()).decode()
+        handler.send_response(101)
+        handler.send_header("Upgrade", "websocket")
+        handler.send_header("Connection", "Upgrade")
+        handler.send_header("Sec-WebSocket-Accept", accept)
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.write_lock = threading.Lock()
+        with self._lock:
+            self._sockets[client_id] = handler
+        self._send_json(client_id, "status", {"status": {"exec_info": {"queue_remaining": self.queue_depth()}}, "sid": client_id})
+        try:
+            while True:   # client frames are only read to detect the close
+                header = handler.rfile.read(2)
+                if len(header) < 2:
+                    break
+                opcode, length = header[0] & 0x0F, header[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack(">H", handler.rfile.read(2))[0]
+                elif length == 127:
+                    length = struct.unpack(">Q", handler.rfile.read(8))[0]
+                handler.rfile.read(4 + length)   # mask + payload
+                if opcode == 0x8:
+                    break
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                if self._sockets.get(client_id) is handler:
+                    del self._sockets[client_id]
+        handler.close_connection = True
+    # endregion
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True   # headers and body are two writes, keep-alive clients would wait on delayed ACKs
+
+            def log_message(self, format, *args):
+                pass
+
+            def _reply(self, body, content_type="application/json", status=200):
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                query = urllib.parse.parse_qs(url.query)
+                if url.path == "/ws":
+                    fake._serve_ws(self, query.get("clientId", [str(uuid.uuid4())])[0])
+                elif url.path.startswith("/history/"):
+                    prompt_id = url.path.rsplit("/", 1)[1]
+                    self._reply({prompt_id: fake.history[prompt_id]} if prompt_id in fake.history else {})
+                elif url.path == "/view":
+                    image_data = fake.files.get(query.get("filename", [""])[0])
+                    if image_data is None:
+                        self._reply({"error": "not found"}, status=404)
+                    else:
+                        self._reply(image_data, content_type="image/png")
+                elif url.path == "/queue":
+                    self._reply(fake._queue_listing())
+                else:
+                    self._reply({"error": "not found"}, status=404)
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if self.path == "/prompt":
+                    self._reply({"prompt_id": fake._add_job(body), "number": 0, "node_errors": {}})
+                elif self.path == "/queue":
+                    if body.get("clear"):
+                        fake._delete([job["prompt_id"] for job in fake._pending])
+                    fake._delete(body.get("delete", []))
+                    self._reply({})
+                elif self.path == "/interrupt":
+                    fake._interrupt(body.get("prompt_id"))
+                    self._reply({})
+                else:
+                    self._reply({"error": "not found"}, status=404)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fake ComfyUI server")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds per job")
+    parser.add_argument("--image-size", type=int, nargs=2, default=None, metavar=("WIDTH", "HEIGHT"))
+    args = parser.parse_args()
+    server = FakeComfyUI(port=args.port, latency=args.latency, image_size=args.image_size).start()
+    print(f"fake ComfyUI listening on {server.server_address}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,238 @@
+""" frames the generated art of the whole card pool (cards/{card_id}.png -> cards_framed/{card_id}.png) on a process pool
+
+    python -m lib.artdesign.frame_cards --workers 8
+    python -m lib.artdesign.frame_cards --parquet lib/cardpool/fac_Orcs.parquet --limit 20 --workers 1
+    python -m lib.artdesign.frame_cards            # again: only the cards whose art, row, layout or assets changed
+
+    each card also gets the derivatives of the layout spec (cards_framed/thumb/{card_id}.webp, web/..., print/...jpg),
+    listed with their size in bytes in the manifest
+"""
+import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import time
+
+import polars as pl
+
+from lib.artdesign import CardLayout
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CARD_FIELDS = ["card_id", "faction", "mana", "advancing", "shield", "condition", "effect", "effect_number", "rare", "name"]
+
+
+def find_jobs(art_dir, parquet_path):
+    """
+        joins the art files ({card_id}.png) with the card pool in one pass
+        returns ([card dict + "art_path", ...] sorted by card_id, [art files without a card], number of cards without art)
+    """
+    files = sorted(f for f in os.listdir(art_dir) if f.endswith(".png"))
+    arts = pl.DataFrame({"card_id": [os.path.splitext(f)[0] for f in files], "art_path": [os.path.join(art_dir, f) for f in files]},
+                        schema={"card_id": pl.String, "art_path": pl.String})
+    cardpool = pl.read_parquet(parquet_path, columns=CARD_FIELDS)
+    jobs = arts.join(cardpool, on="card_id", how="inner").sort("card_id").to_dicts()
+    unknown = arts.join(cardpool, on="card_id", how="anti")["art_path"].to_list()
+    missing = cardpool.join(arts, on="card_id", how="anti").height
+    return jobs, unknown, missing
+
+
+class FrameManifest:
+    """
+        what every framed card was built from: {"cards": {card_id: {"art", "row", "layout", "assets": {file: sha256}}},
+        "files": {path: [mtime_ns, size, sha256]}, "derivatives": {card_id: {name: {"path", "size", "bytes"}}}}.
+        The files table spares re-hashing the art files that did not change.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.cards, self.files, self.derivatives = {}, {}, {}
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                manifest = json.load(file)
+            self.cards, self.files, self.derivatives = manifest.get("cards", {}), manifest.get("files", {}), manifest.get("derivatives", {})
+
+    def digest(self, path):
+        stat = os.stat(path)
+        known = self.files.get(path)
+        if known and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2]
+        sha = hashlib.sha256()
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        self.files[path] = [stat.st_mtime_ns, stat.st_size, sha.hexdigest()]
+        return self.files[path][2]
+
+    def deps(self, card, layout):
+        """ the inputs of one card as recorded in the manifest """
+        row = json.dumps({field: card[field] for field in CARD_FIELDS}, sort_keys=True)
+        dependencies = layout.dependencies(card)
+        return {"art": self.digest(card["art_path"]), "row": hashlib.sha256(row.encode("utf-8")).hexdigest()[:16],
+                "layout": dependencies["layout"],
+                "assets": {name: self.digest(os.path.join(layout.assets_dir, name)) for name in dependencies["assets"]}}
+
+    def is_fresh(self, card_id, deps, out_path):
+        out_dir = os.path.dirname(out_path)
+        return (self.cards.get(card_id) == deps and os.path.exists(out_path)
+                and all(os.path.exists(os.path.join(out_dir, derivative["path"])) for derivative in self.derivatives.get(card_id, {}).values()))
+
+    def record(self, card_id, deps, derivatives=None):
+        self.cards[card_id] = deps
+        if derivatives:
+            self.derivatives[card_id] = derivatives
+        else:
+            self.derivatives.pop(card_id, None)
+
+    def save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"cards": self.cards, "files": self.files, "derivatives": self.derivatives}, file)
+        os.replace(tmp_path, self.path)
+
+
+# one CardLayout per worker process: its sprites, fonts, masks and render plans stay warm from one chunk to the next
+_layout = None
+
+
+def _init_worker(layout_path, render_at_output, derivatives):
+    global _layout
+    _layout = CardLayout(spec_path=layout_path, render_at_output=render_at_output, derivatives=derivatives)
+
+
+def _frame_chunk(chunk, out_dir, compress_level):
+    """ frames a list of cards, returns one {"card_id", "status", "seconds", "derivatives" (, "art_path", "error")} per card """
+    results = []
+    for card in chunk:
+        start = time.time()
+        out_path = os.path.join(out_dir, f"{card['card_id']}.png")
+        tmp_path = os.path.join(out_dir, f".{card['card_id']}.{os.getpid()}.png")
+        try:
+            im = _layout.frame_card(card["art_path"], card, out_path=tmp_path, compress_level=compress_level)
+            os.replace(tmp_path, out_path)   # a killed worker never leaves a half written card
+            derivatives = _layout.save_derivatives(im, out_dir, card["card_id"])
+            results.append({"card_id": card["card_id"], "status": "done", "seconds": round(time.time() - start, 3), "derivatives": derivatives})
+        except Exception as e:   # one bad art file or card row must not stop the batch, it goes to the error report
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            results.append({"card_id": card["card_id"], "status": "failed", "seconds": round(time.time() - start, 3),
+                            "art_path": card["art_path"], "error": f"{type(e).__name__}: {e}"})
+    return results
+
+
+def frame_cards(art_dir=None, parquet_path=None, out_dir=None, workers=None, chunk_size=16, layout_path=None, report_path=None,
+                limit=None, compress_level=6, manifest_path=None, force=False, render_at_output=False,
+                derivatives=True, progress=True):
+    """
+        art_dir: generated art, defaults to lib/artdesign/cards
+        parquet_path: card pool, defaults to lib/cardpool/cardpool.parquet
+        out_dir: defaults to lib/artdesign/cards_framed
+        workers: processes, defaults to the number of cores (1: everything runs in this process, handy to profile)
+        chunk_size: cards sent to a worker at once
+        layout_path: layout spec, defaults to card_layout.json
+        report_path: jsonl error report, one line per failed card, defaults to frame_errors.jsonl next to out_dir
+        limit: only frame the first cards (debugging)
+        compress_level: png compression, the encoding is most of the time spent per card: 1 is ~4x faster for ~15% bigger files
+        manifest_path: inputs of every framed card (FrameManifest), defaults to <out_dir>_manifest.json. Only the cards whose
+            art, row fields, layout ops or asset files changed since they were framed are framed again.
+        force: frame every card (e.g. after a change in the CardLayers code itself, which the manifest does not track)
+        render_at_output: resize the art to the card size before drawing the layers, see CardLayout
+        derivatives: also save the thumb / web / print copies of the layout spec (see CardLayout.save_derivatives)
+        returns {"done", "failed": [card_id, ...], "up_to_date", "unknown_art", "missing_art", "seconds", "cards_per_s",
+                 "derivative_bytes": {name: total bytes of the cards framed}}
+    """
+    art_dir = art_dir or os.path.join(HERE, "cards")
+    parquet_path = parquet_path or os.path.join(HERE, "..", "cardpool", "cardpool.parquet")
+    out_dir = out_dir or os.path.join(HERE, "cards_framed")
+    report_path = report_path or os.path.join(os.path.dirname(os.path.abspath(out_dir)), "frame_errors.jsonl")
+    manifest_path = manifest_path or f"{os.path.abspath(out_dir)}_manifest.json"
+    workers = workers or os.cpu_count() or 1
+    os.makedirs(out_dir, exist_ok=True)
+
+    jobs, unknown, missing = find_jobs(art_dir, parquet_path)
+    if limit:
+        jobs = jobs[:limit]
+    start = time.time()
+    manifest = FrameManifest(manifest_path)
+    layout = CardLayout(spec_path=layout_path, render_at_output=render_at_output, derivatives=derivatives)
+    deps, todo = {}, []
+    for card in jobs:
+        card_id = card["card_id"]
+        try:
+            deps[card_id] = manifest.deps(card, layout)
+        except (OSError, ValueError):   # e.g. unknown effect or missing asset, the worker reports the error
+            deps[card_id] = None
+        if force or deps[card_id] is None or not manifest.is_fresh(card_id, deps[card_id], os.path.join(out_dir, f"{card_id}.png")):
+            todo.append(card)
+    up_to_date = len(jobs) - len(todo)
+    jobs = todo
+    if progress:
+        print(f"{len(jobs)} cards to frame with {workers} workers, {up_to_date} up to date "
+              f"({len(unknown)} art files without a card, {missing} cards without art)")
+    chunks = [jobs[i:i + chunk_size] for i in range(0, len(jobs), chunk_size)]
+
+    done, failed = 0, []
+    derivative_bytes = collections.Counter()
+    last_print = start
+    with open(report_path, "w") as report:
+        def collect(results):
+            nonlocal done, last_print
+            for result in results:
+                if result["status"] == "done":
+                    done += 1
+                    derivative_bytes.update({name: derivative["bytes"] for name, derivative in result["derivatives"].items()})
+                    if deps[result["card_id"]] is not None:
+                        manifest.record(result["card_id"], deps[result["card_id"]], result["derivatives"])
+                else:
+                    failed.append(result["card_id"])
+                    report.write(json.dumps(result) + "\n")
+            if time.time() - last_print > 1 or done + len(failed) == len(jobs):
+                manifest.save()   # a crash only loses the last second of work
+                last_print = time.time()
+                elapsed = last_print - start
+                if progress:
+                    print(f"{done + len(failed)}/{len(jobs)} cards, {(done + len(failed)) / elapsed:.1f} cards/s, {len(failed)} failed")
+
+        if workers == 1:
+            _init_worker(layout_path, render_at_output, derivatives)
+            for chunk in chunks:
+                collect(_frame_chunk(chunk, out_dir, compress_level))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                        initargs=(layout_path, render_at_output, derivatives)) as pool:
+                futures = [pool.submit(_frame_chunk, chunk, out_dir, compress_level) for chunk in chunks]
+                for future in concurrent.futures.as_completed(futures):
+                    collect(future.result())
+
+    manifest.save()
+    seconds = time.time() - start
+    if progress and failed:
+        print(f"{len(failed)} cards failed, see {report_path}")
+    return {"done": done, "failed": failed, "up_to_date": up_to_date, "unknown_art": len(unknown), "missing_art": missing, "seconds": round(seconds, 2),
+            "cards_per_s": round(len(jobs) / seconds, 2) if seconds else None, "derivative_bytes": dict(derivative_bytes)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="frames the generated art of the card pool")
+    parser.add_argument("--art-dir", default=None, help="generated art ({card_id}.png), defaults to lib/artdesign/cards")
+    parser.add_argument("--parquet", default=None, help="card pool, defaults to lib/cardpool/cardpool.parquet")
+    parser.add_argument("--out-dir", default=None, help="defaults to lib/artdesign/cards_framed")
+    parser.add_argument("--workers", type=int, default=None, help="processes, defaults to the number of cores")
+    parser.add_argument("--chunk-size", type=int, default=16)
+    parser.add_argument("--layout", default=None, help="layout spec, defaults to lib/artdesign/card_layout.json")
+    parser.add_argument("--report", default=None, help="jsonl error report, defaults to frame_errors.jsonl next to the out dir")
+    parser.add_argument("--limit", type=int, default=None, help="only frame the first cards")
+    parser.add_argument("--compress-level", type=int, default=6, help="png compression 0-9, 1 encodes ~4x faster")
+    parser.add_argument("--manifest", default=None, help="inputs of the framed cards, defaults to <out dir>_manifest.json")
+    parser.add_argument("--force", action="store_true", help="frame every card, even the up to date ones")
+    parser.add_argument("--render-at-output", action="store_true", help="resize the art to the card size before drawing the layers")
+    parser.add_argument("--no-derivatives", action="store_true", help="only save the full size png of each card")
+    args = parser.parse_args()
+    result = frame_cards(art_dir=args.art_dir, parquet_path=args.parquet, out_dir=args.out_dir, workers=args.workers, chunk_size=args.chunk_size,
+                         layout_path=args.layout, report_path=args.report, limit=args.limit, compress_level=args.compress_level,
+                         manifest_path=args.manifest, force=args.force, render_at_output=args.render_at_output, derivatives=not args.no_derivatives)
+    print(json.dumps({key: value for key, value in result.items() if key != "failed"}))
+
+
+if __name__ == "__main__":
+    main()
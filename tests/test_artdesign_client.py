@@ -0,0 +1,252 @@
+""" ArtDesignClient, ArtCache, PriorityArtQueue and ArtDesignPool against FakeComfyUI (no GPU, no ComfyUI needed)
+
+    python -m pytest -q tests
+"""
+import concurrent.futures
+import gc
+import json
+import os
+import re
+import socket
+import threading
+import time
+
+import polars as pl
+import pytest
+
+from lib.artdesign import ArtCache, ArtDesignClient, ArtDesignPool, ArtJobRunner, HttpConnectionPool, JobTimer, PriorityArtQueue
+from lib.artdesign.fake_comfyui import FakeComfyUI
+
+PROMPT = ("a dwarf holding an axe", "blurry")
+SIZE = (64, 64)
+
+
+@pytest.fixture
+def server():
+    with FakeComfyUI(latency=0.1, steps=2, send_previews=False) as fake:
+        yield fake
+
+
+def prompts(n):
+    return [(f"{PROMPT[0]} {i}", PROMPT[1]) for i in range(n)]
+
+
+# region HttpConnectionPool
+class ResettingServer:
+    """ HTTP server answering the first request of each connection, then reading the second one and closing without a reply """
+    def __init__(self):
+        self.requests = []
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.server_address = f"127.0.0.1:{self.listener.getsockname()[1]}"
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            try:
+                connection, _ = self.listener.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._connection, args=(connection,), daemon=True).start()
+
+    def _connection(self, connection):
+        with connection, connection.makefile("rb") as file:
+            for n in range(2):
+                request_line = file.readline().decode()
+                length = 0
+                for line in iter(file.readline, b"\r\n"):
+                    if line.lower().startswith(b"content-length:"):
+                        length = int(line.split(b":")[1])
+                file.read(length)
+                self.requests.append(request_line.split()[0])
+                if n == 0:
+                    connection.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+
+    def close(self):
+        self.listener.close()
+
+
+@pytest.mark.parametrize("method, retried", [("GET", True), ("POST", False)])
+def test_http_pool_retries_only_what_the_server_cannot_have_run(method, retried):
+    server = ResettingServer()
+    http = HttpConnectionPool(server.server_address)
+    try:
+        assert http.request("GET", "/queue") == b"ok"
+        if retried:
+            assert http.request(method, "/prompt", body=b"{}") == b"ok"
+        else:
+            with pytest.raises(ConnectionError):
+                http.request(method, "/prompt", body=b"{}")
+    finally:
+        http.close()
+        server.close()
+    assert server.requests == ["GET", method] + ([method] if retried else [])
+    assert http.report()["retries"] == (1 if retried else 0)
+# endregion
+
+
+# region ArtCache
+def test_cache_hit_skips_the_server(server, tmp_path):
+    client = ArtDesignClient(server.server_address, cache=ArtCache(str(tmp_path)))
+    first = client.run_prompts(prompts(2), size=SIZE)
+    second = client.run_prompts(prompts(2), size=SIZE)
+    assert server.stats["jobs"] == 2
+    assert [image.tobytes() for image in first] == [image.tobytes() for image in second]
+    assert client.cache.report()["hits"] == 2 and client.cache.report()["misses"] == 2
+
+
+def test_session_keeps_one_websocket_per_live_thread(server):
+    client = ArtDesignClient(server.server_address, session=True)
+    client.run_prompts(prompts(1), size=SIZE)
+    first_ws, _ = client.get_ws()
+    first_ws.close()   # dropped: the next call reconnects
+    client.run_prompts(prompts(1), size=SIZE)
+    for _ in range(3):   # threads that end
+        thread = threading.Thread(target=client.run_prompts, args=(prompts(1),), kwargs={"size": SIZE})
+        thread.start()
+        thread.join()
+    gc.collect()
+    assert list(client._session_sockets) == [threading.get_ident()]
+    assert client._session_sockets[threading.get_ident()] is not first_ws
+    client.close()
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = ArtCache(str(tmp_path), max_mb=2500 / 2 ** 20)
+    cache.put("a", {"9": [b"a" * 1000]})
+    cache.put("b", {"9": [b"b" * 1000]})
+    assert cache.get("a") == {"9": [b"a" * 1000]}   # "b" is now the least recently used
+    cache.put("c", {"9": [b"c" * 1000]})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.report()["evictions"] == 1
+    cache.put("a", {"9": [b"a" * 500]})   # rewritten smaller: the size total follows
+    assert cache.size_bytes == 1500
+
+    reopened = ArtCache(str(tmp_path), max_mb=2500 / 2 ** 20)   # the entries on disk are found back
+    assert reopened.get("c") == {"9": [b"c" * 1000]}
+    assert reopened.report()["entries"] == 2
+# endregion
+
+
+# region job_timeout
+def test_job_timeout_cancels_and_requeues_once():
+    with FakeComfyUI(latency=3.0, steps=10, send_previews=False) as slow:
+        client = ArtDesignClient(slow.server_address, job_timeout=0.5, max_requeue=1, timer=JobTimer())
+        start = time.time()
+        results = list(client.iter_prompts([("card_1", PROMPT)], size=SIZE, save=False))
+        elapsed = time.time() - start
+        time.sleep(0.5)   # lets the server record the second interruption
+        statuses = [entry["status"]["status_str"] for entry in slow.history.values()]
+    assert results == [("card_1", [])]   # given up after its requeue
+    assert statuses == ["error", "error"]
+    assert elapsed < 3.0
+    assert [record["cancelled"] > 0.5 for record in client.timer.records()] == [True, True]
+    assert client.timer.summary()["cancelled"] == 2
+
+
+def test_job_runner_backs_off_when_no_image_is_returned(tmp_path, capsys):
+    parquet_path = str(tmp_path / "cards.parquet")
+    pl.DataFrame({"card_id": ["card_1"], "prompt": [PROMPT[0]], "negative_prompt": [PROMPT[1]]}).write_parquet(parquet_path)
+    with FakeComfyUI(latency=5.0, steps=10, send_previews=False) as slow:
+        client = ArtDesignClient(slow.server_address, job_timeout=0.3, max_requeue=0)   # every job comes back empty
+        runner = ArtJobRunner(client, parquet_path, out_dir=str(tmp_path / "cards"), max_retries=3, backoff=0.1)
+        result = runner.run(size=SIZE)
+    waits = [float(wait) for wait in re.findall(r"no image returned, retrying in ([\d.]+)s", capsys.readouterr().out)]
+    assert result == {"done": 0, "failed": ["card_1"]}
+    assert waits == [0.1, 0.2]   # doubled like after a connection error, no wait once the card is given up
+    with open(runner.manifest_path, "r") as file:
+        assert [json.loads(line)["status"] for line in file] == ["failed"]
+
+
+def test_job_runner_cancels_the_chunk_when_the_websocket_drops(tmp_path):
+    parquet_path = str(tmp_path / "cards.parquet")
+    card_ids = [f"card_{i}" for i in range(4)]
+    pl.DataFrame({"card_id": card_ids, "prompt": [prompt[0] for prompt in prompts(4)],
+                  "negative_prompt": [PROMPT[1]] * 4}).write_parquet(parquet_path)
+    with FakeComfyUI(latency=0.4, steps=8, send_previews=False) as fake:
+        runner = ArtJobRunner(ArtDesignClient(fake.server_address), parquet_path, out_dir=str(tmp_path / "cards"), chunk_size=4, backoff=0.05)
+        threading.Timer(0.6, fake.drop_websockets).start()   # while the second card runs
+        result = runner.run(size=SIZE)
+        time.sleep(0.2)
+        completed = [entry for entry in fake.history.values() if entry["status"]["completed"]]
+    assert result == {"done": 4, "failed": []}
+    assert len(completed) == 4   # the prompts of the dropped chunk did not run anyway
+    assert sorted(os.listdir(tmp_path / "cards")) == [f"{card_id}.png" for card_id in card_ids]
+# endregion
+
+
+# region PriorityArtQueue
+def test_interactive_prompt_jumps_the_bulk_backlog(server):
+    done = []
+    with PriorityArtQueue(ArtDesignClient(server.server_address), feed_depth=1) as art_queue:
+        bulk = [art_queue.submit(prompt, priority="bulk", size=SIZE) for prompt in prompts(6)]
+        for n, future in enumerate(bulk):
+            future.add_done_callback(lambda future, n=n: done.append(f"bulk {n}"))
+        time.sleep(0.05)
+        interactive = art_queue.submit(("a dwarf king", ""), priority="interactive", size=SIZE)
+        interactive.add_done_callback(lambda future: done.append("interactive"))
+        concurrent.futures.wait(bulk + [interactive], timeout=10)
+    assert interactive.result()
+    assert all(future.result() for future in bulk)
+    assert done.index("interactive") <= 2   # behind the bulk prompts already on ComfyUI at most
+    assert art_queue.report()["bulk"]["jobs"] == 6
+
+
+def test_queue_fails_every_prompt_when_the_websocket_drops():
+    server = FakeComfyUI(latency=0.3, steps=2, send_previews=False).start()
+    art_queue = PriorityArtQueue(ArtDesignClient(server.server_address), feed_depth=2)
+    try:
+        futures = [art_queue.submit(prompt, size=SIZE) for prompt in prompts(6)]
+        time.sleep(0.4)
+        server.stop()
+        late = art_queue.submit(PROMPT, size=SIZE)
+        outcomes = []
+        for future in futures + [late]:
+            try:
+                future.result(timeout=5)
+                outcomes.append("ok")
+            except ConnectionError:
+                outcomes.append("failed")
+    finally:
+        art_queue.close()
+    assert outcomes[-1] == "failed"
+    assert outcomes.count("failed") >= 5   # nothing left hanging
+
+
+def test_queue_close_fails_the_prompts_in_flight_and_later_submits():
+    with FakeComfyUI(latency=0.5, steps=5, send_previews=False) as slow:
+        art_queue = PriorityArtQueue(ArtDesignClient(slow.server_address), feed_depth=2)
+        futures = [art_queue.submit(prompt, size=SIZE) for prompt in prompts(4)]
+        time.sleep(0.2)   # two on ComfyUI, two waiting client side
+        art_queue.close()
+        late = art_queue.submit(PROMPT, size=SIZE)
+        for future in futures + [late]:
+            with pytest.raises(ConnectionError, match="queue closed"):
+                future.result(timeout=5)
+        time.sleep(0.3)
+        assert slow.queue_depth() == 0   # the running prompts were cancelled on the server too
+        assert slow.stats["jobs"] == 0
+# endregion
+
+
+# region ArtDesignPool
+def test_pool_moves_the_prompts_of_a_dropped_server():
+    with FakeComfyUI(latency=0.1, steps=2, send_previews=False) as steady:
+        dropping = FakeComfyUI(latency=0.1, steps=2, send_previews=False).start()
+        pool = ArtDesignPool([steady.server_address, dropping.server_address], max_queue_depth=2, poll_interval=0.05)
+        threading.Timer(0.25, dropping.stop).start()
+        images = pool.run_prompts(prompts(12), size=SIZE)
+    report = pool.report()
+    assert len(images) == 12
+    assert report[dropping.server_address]["alive"] is False
+    assert report[steady.server_address]["alive"] is True
+    assert sum(stats["jobs"] for stats in report.values()) == 12
+
+
+def test_pool_raises_when_every_server_is_gone():
+    dropping = FakeComfyUI(latency=0.2, steps=2, send_previews=False).start()
+    pool = ArtDesignPool([dropping.server_address], poll_interval=0.05)
+    threading.Timer(0.3, dropping.stop).start()
+    with pytest.raises(ConnectionError):
+        pool.run_prompts(prompts(10), size=SIZE)
+# endregion
@@ -0,0 +1,48 @@
+""" Utils.card_image: the derivatives are looked up in the frame_cards manifest, not on disk
+
+    python -m pytest -q tests
+"""
+import json
+import os
+
+from lib.artdesign import CardLayers, Utils
+from lib.artdesign.bench_layers import CARD, synthetic_art
+
+
+def write_manifest(path, derivatives, mtime_ns):
+    with open(path, "w") as file:
+        json.dump({"cards": {}, "files": {}, "derivatives": derivatives}, file)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_card_image_follows_the_manifest(tmp_path, monkeypatch):
+    manifest_path = str(tmp_path / "cards_framed_manifest.json")
+    monkeypatch.setattr(Utils, "MANIFEST_PATH", manifest_path)
+    monkeypatch.setattr(Utils, "MANIFEST_CHECK_SECONDS", 0.0)
+    utils = Utils()
+    assert utils.card_image("Dwa23_035b16", "thumb") == "Dwa23_035b16.png"   # no manifest yet
+
+    write_manifest(manifest_path, {"Dwa23_035b16": {"thumb": {"path": "thumb/Dwa23_035b16.webp", "size": [233, 317], "bytes": 1}}}, 10 ** 18)
+    assert utils.card_image("Dwa23_035b16", "thumb") == "thumb/Dwa23_035b16.webp"
+    assert utils.card_image("Dwa23_035b16", "print") == "Dwa23_035b16.png"
+    assert utils.card_image("Dwa23_035b16") == "Dwa23_035b16.png"
+    assert utils.card_image("Orc12_001a01", "thumb") == "Orc12_001a01.png"
+
+    write_manifest(manifest_path, {}, 2 * 10 ** 18)   # cards framed again without derivatives
+    assert utils.card_image("Dwa23_035b16", "thumb") == "Dwa23_035b16.png"
+
+
+def test_card_image_finds_the_derivatives_of_add_layer_to_a_card(tmp_path, monkeypatch):
+    out_dir = tmp_path / "cards_framed"
+    monkeypatch.setattr(Utils, "MANIFEST_PATH", f"{out_dir}_manifest.json")
+    monkeypatch.setattr(Utils, "MANIFEST_CHECK_SECONDS", 0.0)
+    art_path = str(tmp_path / f"{CARD['card_id']}.png")
+    synthetic_art(816, 1110).save(art_path)
+
+    CardLayers().add_layer_to_a_card(art_path, CARD["faction"], CARD["mana"], CARD["advancing"], CARD["shield"], CARD["condition"],
+                                     CARD["effect"], CARD["effect_number"], CARD["rare"], CARD["name"], CARD["card_id"], out_dir=str(out_dir))
+    utils = Utils()
+    for variant in ("thumb", "web", "print"):
+        path = utils.card_image(CARD["card_id"], variant)
+        assert path != f"{CARD['card_id']}.png"
+        assert os.path.exists(out_dir / path)